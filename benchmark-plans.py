@@ -0,0 +1,158 @@
+# Runs whole plans against the local mock LLM server (mock-llm-server.py) and reports wall time,
+# the concurrency achieved and the time spent outside LLM calls, so scheduler and conversion
+# changes can be measured offline and repeatably.
+#
+#   python benchmark-plans.py --plan_name plan0000-test plan0408-piecewise --repeat 3 --ttft 1 --tokens_per_second 80
+#
+# Each run writes to ./temp/benchmark/{plan}-{i}/ with its own ledger and rate limit state,
+# so the real ledger.sqlite is not touched.
+
+#%%
+import os
+import sys
+import time
+import shutil
+import socket
+import sqlite3
+import argparse
+import subprocess
+import pandas as pd
+
+BENCHMARK_FOLDER = "./temp/benchmark/"
+
+def wait_for_port(host, port, timeout=30):
+    """Waits until the server accepts connections"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        with socket.socket() as s:
+            if s.connect_ex((host, port)) == 0:
+                return
+        time.sleep(0.1)
+    raise RuntimeError(f"Mock server did not start on {host}:{port}")
+
+def busy_seconds(intervals):
+    """Length of the union of (start, end) intervals, the time at least one call was running"""
+    total = 0.0
+    current_start, current_end = None, None
+    for start, end in sorted(intervals):
+        if current_end is None or start > current_end:
+            if current_end is not None:
+                total += current_end - current_start
+            current_start, current_end = start, end
+        else:
+            current_end = max(current_end, end)
+    if current_end is not None:
+        total += current_end - current_start
+    return total
+
+def peak_concurrency(intervals):
+    """Largest number of calls running at the same time"""
+    events = sorted([(start, 1) for start, _ in intervals] + [(end, -1) for _, end in intervals])
+    peak = running = 0
+    for _, change in events:
+        running += change
+        peak = max(peak, running)
+    return peak
+
+def run_stats(ledger_file):
+    """Summarizes the LLM calls of one benchmark run from its ledger (zero calls if it made none)"""
+    connection = sqlite3.connect(ledger_file)
+    # make-paper.py creates the table on its first call, so a run that failed before may have none
+    has_calls = connection.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'llm_calls'").fetchone()
+    if has_calls:
+        calls_df = pd.read_sql_query("SELECT started, ended, latency_seconds, output_tokens FROM llm_calls", connection)
+    else:
+        calls_df = pd.DataFrame(columns=["started", "ended", "latency_seconds", "output_tokens"])
+    connection.close()
+    intervals = list(zip(
+        pd.to_datetime(calls_df["started"]).map(pd.Timestamp.timestamp),
+        pd.to_datetime(calls_df["ended"]).map(pd.Timestamp.timestamp)
+    ))
+    return {
+        "calls": len(calls_df),
+        "output_tokens": int(calls_df["output_tokens"].sum()),
+        "llm_seconds": calls_df["latency_seconds"].sum(),
+        "llm_busy_seconds": busy_seconds(intervals),
+        "peak_concurrency": peak_concurrency(intervals)
+    }
+
+#%%
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark whole plans against the local mock LLM server")
+    parser.add_argument("--plan_name", type=str, nargs="+", default=["plan0000-test"], help="Plans to run")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs of each plan")
+    parser.add_argument("--max_concurrency", type=int, default=None, help="Passed to make-paper.py (default: the plan config)")
+    parser.add_argument("--port", type=int, default=8766, help="Port for the mock server")
+    parser.add_argument("--ttft", type=float, default=0.5, help="Mock seconds before the first token")
+    parser.add_argument("--tokens_per_second", type=float, default=100, help="Mock output tokens per second")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="Mock fraction of requests that fail with 529/500")
+    parser.add_argument("--drop_rate", type=float, default=0.0, help="Mock fraction of streams that drop halfway")
+    parser.add_argument("--replay", type=str, nargs="*", default=["output*/", "manyout*-detail/run*/"], help="Output folders to replay recorded responses from")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for the mock errors")
+    args = parser.parse_args()
+
+    if os.path.exists(BENCHMARK_FOLDER):
+        shutil.rmtree(BENCHMARK_FOLDER)
+    os.makedirs(BENCHMARK_FOLDER)
+
+    server = subprocess.Popen([
+        sys.executable, "mock-llm-server.py", "--port", str(args.port), "--quiet",
+        "--ttft", str(args.ttft), "--tokens_per_second", str(args.tokens_per_second),
+        "--error_rate", str(args.error_rate), "--drop_rate", str(args.drop_rate),
+        "--seed", str(args.seed), "--replay", *args.replay
+    ])
+    wait_for_port("127.0.0.1", args.port)
+
+    results = []
+    # stop the server even if a run fails to report (e.g. make-paper.py crashed before its first call)
+    try:
+        for plan_name in args.plan_name:
+            for i in range(1, args.repeat + 1):
+                output_folder = os.path.join(BENCHMARK_FOLDER, f"{plan_name}-{i}", "")
+                os.makedirs(output_folder)
+                ledger_file = os.path.join(output_folder, "ledger.sqlite")
+                env = dict(
+                    os.environ,
+                    ANTHROPIC_BASE_URL=f"http://127.0.0.1:{args.port}",
+                    OPENAI_BASE_URL=f"http://127.0.0.1:{args.port}/v1",
+                    ANTHROPIC_API_KEY="mock",
+                    OPENAI_API_KEY="mock",
+                    LLM_LEDGER_FILE=ledger_file,
+                    LLM_RATELIMIT_FILE=os.path.join(output_folder, "ratelimit-state.json"),
+                    LLM_CACHE_MODE="off"
+                )
+                command = [sys.executable, "-u", "make-paper.py", "--plan_name", plan_name, "--output_folder", output_folder, "--force"]
+                if args.max_concurrency:
+                    command += ["--max_concurrency", str(args.max_concurrency)]
+
+                print(f"\n=== {plan_name} run {i} of {args.repeat} ===")
+                time_start = time.time()
+                with open(os.path.join(output_folder, "console.txt"), "w", encoding="utf-8") as console:
+                    result = subprocess.run(command, env=env, stdout=console, stderr=subprocess.STDOUT)
+                wall_seconds = time.time() - time_start
+
+                stats = run_stats(ledger_file)
+                results.append({
+                    "plan": plan_name,
+                    "run": i,
+                    "returncode": result.returncode,
+                    "wall_seconds": wall_seconds,
+                    **stats,
+                    # average number of calls in flight while the plan ran
+                    "concurrency": stats["llm_seconds"] / max(wall_seconds, 1e-6),
+                    # time with no call in flight: startup, prompt assembly, LaTeX, cost reports
+                    "non_llm_seconds": wall_seconds - stats["llm_busy_seconds"]
+                })
+                print(f"{plan_name} run {i}: {wall_seconds:.1f}s wall, {stats['calls']} calls, return code {result.returncode}")
+    finally:
+        server.terminate()
+        server.wait()
+        # save the runs that finished, even if the benchmark was interrupted
+        results_df = pd.DataFrame(results)
+        results_df.to_csv(os.path.join(BENCHMARK_FOLDER, "results.csv"), index=False)
+
+    print("\nBenchmark results:")
+    print(results_df.round(2).to_string(index=False))
+    if len(results_df) > len(args.plan_name):
+        print("\nMean by plan:")
+        print(results_df.drop(columns=["run"]).groupby("plan").mean().round(2).to_string())
@@ -2,17 +2,26 @@
 
 #%%
 import os
+import re
 import glob
-import anthropic
 import time
+import hashlib
+import asyncio
 import textwrap
 from dotenv import load_dotenv
 
 # Load environment variables (API key)
 load_dotenv()
 
-# Initialize Anthropic client
-client = anthropic.Anthropic()
+from utils import MODEL_CONFIG, async_query, run_async, ledger_context
+
+BIBTEX_MODEL = "sonnet"
+
+# Number of lit files converted at once (all on one event loop)
+MAX_CONCURRENT = 8
+
+# Converted lit files are cached here by content hash, so only new or edited files are sent to Claude
+CACHE_FOLDER = "./temp/lit-to-bibtex-cache/"
 
 def print_wrapped(text, width=70):
     """
@@ -38,23 +47,24 @@ def print_wrapped(text, width=70):
         # Print a blank line to preserve paragraph separation
         print()
 
-def convert_to_bibtex(lit_overview):
+BIBTEX_INSTRUCTIONS = """
+    Convert the following literature overview into BibTeX entries. 
+    Include authors, title, journal/conference, year, volume, pages, DOI, if available. Be careful to use only the information provided in the literature overview. Do not change any author names, years, titles, or journal names. Return ONLY the BibTeX entries, nothing else. Format the bibtex entries as [first author][year][title first word], all lowercase, e.g. "chen2025singularity".
+    """
+
+async def convert_to_bibtex(lit_overview, file_name="lit"):
     """
     Sends a literature overview to Claude and asks it to convert to BibTeX format.
     
     Args:
         lit_overview (str): The text of the literature overview.
+        file_name (str): Name of the lit file, for the saved message.
         
     Returns:
         str: The BibTeX entries for the paper.
     """
-    instructions = """
-    Convert the following literature overview into BibTeX entries. 
-    Include authors, title, journal/conference, year, volume, pages, DOI, if available. Be careful to use only the information provided in the literature overview. Do not change any author names, years, titles, or journal names. Return ONLY the BibTeX entries, nothing else. Format the bibtex entries as [first author][year][title first word], all lowercase, e.g. "chen2025singularity".
-    """
-    
     message = f"""
-    {instructions}
+    {BIBTEX_INSTRUCTIONS}
     
     LITERATURE OVERVIEW:
     {lit_overview}
@@ -62,34 +72,67 @@ def convert_to_bibtex(lit_overview):
     
     print(f"Sending request to Claude for lit overview: {lit_overview[:1000]}...")
 
-    # save message to temp/message-lit-to-bibtex.txt
-    with open("./temp/message-lit-to-bibtex.txt", "w", encoding="utf-8") as f:
+    # save message to temp/message-lit-to-bibtex-{file_name}.txt
+    with open(f"./temp/message-lit-to-bibtex-{file_name}.txt", "w", encoding="utf-8") as f:
         f.write(message)
     
     # Start timer
     start_time = time.time()
     
     # Query Claude
-    response = client.messages.create(
-        model="claude-3-7-sonnet-20250219",
+    llmdat = await async_query(
+        BIBTEX_MODEL,
+        message,
+        system_prompt="",
         max_tokens=5000,
-        temperature=0.2,
-        messages=[
-            {"role": "user", "content": message}
-        ]
+        temperature=0.2
     )
     
     # End timer
     end_time = time.time()
     print(f"Time taken: {round((end_time - start_time), 2)} seconds")
     
-    return response.content[0].text.strip()
+    return llmdat["response"].strip()
+
+def lit_file_hash(lit_overview):
+    """Hashes a lit file together with the conversion instructions and model, the key for the cache"""
+    hash_text = "\n".join([MODEL_CONFIG[BIBTEX_MODEL]["full_name"], BIBTEX_INSTRUCTIONS, lit_overview])
+    return hashlib.sha256(hash_text.encode("utf-8")).hexdigest()
+
+def cached_bibtex(lit_overview):
+    """Returns the cached BibTeX for a lit file, or None if it has not been converted yet"""
+    cache_file = f"{CACHE_FOLDER}{lit_file_hash(lit_overview)}.bib"
+    if not os.path.exists(cache_file):
+        return None
+    with open(cache_file, "r", encoding="utf-8") as f:
+        return f.read()
+
+async def convert_and_cache(file_name, lit_overview, semaphore):
+    """Converts a lit file to BibTeX and saves the result to the cache"""
+    async with semaphore:
+        bibtex_claude = await convert_to_bibtex(lit_overview, file_name)
+    cache_file = f"{CACHE_FOLDER}{lit_file_hash(lit_overview)}.bib"
+    with open(f"{cache_file}.tmp", "w", encoding="utf-8") as f:
+        f.write(bibtex_claude)
+    os.replace(f"{cache_file}.tmp", cache_file)
+    return bibtex_claude
+
+def split_bibtex_entries(bibtex):
+    """Splits BibTeX text into (key, entry) pairs, dropping code fences and stray text"""
+    bibtex = "\n".join([line for line in bibtex.split("\n") if "```" not in line])
+    entries = []
+    for chunk in re.split(r"\n(?=\s*@)", bibtex):
+        match = re.match(r"\s*@\w+\s*\{\s*([^,\s]+)\s*,", chunk)
+        if match:
+            entries.append((match.group(1), chunk.strip()))
+    return entries
 
 #%%
 # Main 1: Setup
 
 # Create temp directory if it doesn't exist
 os.makedirs("./temp", exist_ok=True)
+os.makedirs(CACHE_FOLDER, exist_ok=True)
 
 # Gather all bib*.txt files from prompts directory
 bib_files = sorted(glob.glob("./lit-context/lit-*.txt"))
@@ -101,47 +144,61 @@ print(f"Found {len(bib_files)} bibliography files.")
 
 
 #%%
-# Main 2: Convert to BibTeX
-
-# Process each file and collect BibTeX entries
-all_bibtex = []
+# Main 2: Convert to BibTeX (only files that are not in the cache)
 
+lit_overviews = {}
 for file_path in bib_files:
     file_name = os.path.basename(file_path)
-    print(f"\nProcessing {file_name}...")
-    
     with open(file_path, "r", encoding="utf-8") as f:
         lit_overview = f.read().strip()
-    
+
     if not lit_overview:
         print(f"Skipping empty file: {file_name}")
         continue
-    
-    bibtex_claude = convert_to_bibtex(lit_overview)        
+    lit_overviews[file_name] = lit_overview
 
-    all_bibtex.append(f"% From {file_name}\n{bibtex_claude}\n")
+bibtex_by_file = {file_name: cached_bibtex(lit_overview) for file_name, lit_overview in lit_overviews.items()}
+changed_files = [file_name for file_name, bibtex in bibtex_by_file.items() if bibtex is None]
+print(f"{len(lit_overviews) - len(changed_files)} files unchanged (cached), converting {len(changed_files)}: {changed_files}")
 
-#%%
-
-# clean up output
+async def convert_changed_files():
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT)
+    return await asyncio.gather(*[convert_and_cache(file_name, lit_overviews[file_name], semaphore) for file_name in changed_files])
 
-all_bibtex_clean = []
+with ledger_context(operation="BibTeX"):
+    converted = run_async(convert_changed_files())
+bibtex_by_file.update(zip(changed_files, converted))
 
-for bibtex in all_bibtex:
-    # remove any lines with ```
-    bibtex_clean = "\n".join([line for line in bibtex.split("\n") if "```" not in line])
-    all_bibtex_clean.append(bibtex_clean)
+#%%
+# Merge in file order, keeping the first entry for each key
 
+all_bibtex_clean = []
+seen_keys = {}
+for file_name in sorted(bibtex_by_file):
+    entries = []
+    for key, entry in split_bibtex_entries(bibtex_by_file[file_name]):
+        if key in seen_keys:
+            print(f"Dropping duplicate key {key} in {file_name} (first seen in {seen_keys[key]})")
+            continue
+        seen_keys[key] = file_name
+        entries.append(entry)
+    all_bibtex_clean.append(f"% From {file_name}\n" + "\n\n".join(entries) + "\n")
 
 #%%
 # save to file
 
-# save for prompt
+# save for prompt (only rewritten if the merged entries changed)
 output_path1 = "./lit-context/bibtex-all.bib"
-with open(output_path1, "w", encoding="utf-8") as f:
-    f.write("\n\n".join(all_bibtex_clean))
-
-print(f"\nAll BibTeX entries have been saved to {output_path1}")
-
-
-
+bibtex_all = "\n\n".join(all_bibtex_clean)
+if os.path.exists(output_path1):
+    with open(output_path1, "r", encoding="utf-8") as f:
+        bibtex_old = f.read()
+else:
+    bibtex_old = None
+
+if bibtex_all != bibtex_old:
+    with open(output_path1, "w", encoding="utf-8") as f:
+        f.write(bibtex_all)
+    print(f"\nAll {len(seen_keys)} BibTeX entries have been saved to {output_path1}")
+else:
+    print(f"\n{output_path1} is unchanged ({len(seen_keys)} entries)")
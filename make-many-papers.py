@@ -3,16 +3,59 @@
 import os
 import shutil
 import subprocess
-from datetime import datetime
-import time
-import yaml
 import sys
+import argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from utils import is_jupyter, compile_plan, critical_path_priority, run_prompt_dag
+from utils import MODEL_CONFIG, prepare_step, save_step_prompt, query_step, finish_step, batch_query_claude, compile_full_paper, save_all_costs
+from utils import ledger_context, submit_in_context, fork_prefix, fork_run_folder
+from utils import forecast_plan, print_forecast, BATCH_PRICE_FACTOR
+
+load_dotenv()
 
 # User input
-plan_name = 'plan0408-piecewise'
-# plan_name = 'plan0000-test'
-run_start = 1
-run_end = 5
+plan_default = 'plan0408-piecewise'
+# plan_default = 'plan0000-test'
+
+if is_jupyter():
+    plan_name = plan_default
+    run_start = 1
+    run_end = 5
+    jobs = 1
+    skip_confirm = False
+    batch_mode = False
+    poll_seconds = 30
+    dry_run = False
+    budget_arg = None
+    fork_after = None
+    prefix_runs = 1
+else:
+    parser = argparse.ArgumentParser(description="Generate many papers from a plan")
+    parser.add_argument("--plan_name", type=str, default=plan_default, help="Name of the plan to use")
+    parser.add_argument("--run_start", type=int, default=1, help="First run id")
+    parser.add_argument("--run_end", type=int, default=5, help="Last run id")
+    parser.add_argument("--jobs", type=int, default=1, help="Number of runs to execute at once")
+    parser.add_argument("--yes", action="store_true", help="Skip the confirmation prompt")
+    parser.add_argument("--batch", action="store_true", help="Send each step of all runs as one Message Batch (half price, not interactive)")
+    parser.add_argument("--poll_seconds", type=float, default=30, help="Seconds between batch status checks")
+    parser.add_argument("--dry_run", "--dry-run", action="store_true", help="Print the projected tokens, cost and time for all runs, then stop")
+    parser.add_argument("--budget", type=float, default=None, help="Refuse to start if the projected cost (USD) of all runs is higher (default: budget in the plan config times the number of runs)")
+    parser.add_argument("--fork_after", type=int, default=None, help="Run the first K steps once per prefix run, then branch every run from a shared prefix (default: no forking)")
+    parser.add_argument("--prefix_runs", type=int, default=1, help="Number of shared prefix runs with --fork_after (runs are spread over them in turn)")
+    args = parser.parse_args()
+    plan_name = args.plan_name
+    run_start = args.run_start
+    run_end = args.run_end
+    jobs = args.jobs
+    skip_confirm = args.yes
+    batch_mode = args.batch
+    poll_seconds = args.poll_seconds
+    dry_run = args.dry_run
+    budget_arg = args.budget
+    fork_after = args.fork_after
+    prefix_runs = args.prefix_runs
 
 # Extract plan number and name
 temp_num, temp_name = plan_name.split("plan")[1].split("-")
@@ -28,55 +71,235 @@ os.makedirs(pdf_folder, exist_ok=True)
 #%%
 # Check with user before running
 
-# Read run range from YAML file for display purposes
-yaml_file = f"{plan_name}.yaml"
-with open(yaml_file, 'r') as file:
-    plan_config = yaml.safe_load(file)
+# Load and check the whole plan before any run starts (unknown models, token limits,
+# missing lit/latex files); saved as execution-plan.json
+execution_plan = compile_plan(plan_name, detail_folder)
+if fork_after:
+    # steps 1..fork_after run once per prefix run, every paper run branches from one of them
+    prefix_names = fork_prefix(execution_plan, fork_after)
+    prefix_runs = max(1, min(prefix_runs, run_end - run_start + 1))
 print(f"\nMany Runs Setting:")
 print(f"run_start: {run_start}")
 print(f"run_end: {run_end}")
+print(f"jobs: {jobs}")
+print(f"batch mode: {batch_mode}")
+if fork_after:
+    print(f"fork after: {', '.join(prefix_names)} ({prefix_runs} prefix runs)")
 
 print(f"\nPlan Details:")
 print(f"  Plan Name: {plan_name}")
-print(f"  Plan Start: {plan_config['config']['run_range']['start']}")
-print(f"  Plan End: {plan_config['config']['run_range']['end']}")
+print(f"  Plan Start: {execution_plan['config']['run_range']['start']}")
+print(f"  Plan End: {execution_plan['config']['run_range']['end']}")
 print(f"\nOutput will be saved to:")
 print(f"  Detail folder: {detail_folder}")
 print(f"  PDF folder: {pdf_folder}")
 
-user_input = input("\nPress Enter to continue or 'q' to quit: ")
-if user_input.lower() == 'q':
-    print("Operation cancelled by user.")
+# Forecast one fresh run, then scale to all runs
+n_runs = run_end - run_start + 1
+forecast_config = execution_plan["config"]
+forecast_df, forecast = forecast_plan(
+    plan_name,
+    forecast_config,
+    execution_plan["prompts"],
+    execution_plan["indices"],
+    max_concurrency=forecast_config.get("max_concurrency", 1),
+    price_factor=BATCH_PRICE_FACTOR if batch_mode else 1.0
+)
+print(f"\nForecast{' (batch prices, wall time excludes batch queueing)' if batch_mode else ''}:")
+print_forecast(forecast_df, forecast, n_runs=n_runs, wall_factor=1 if batch_mode else -(-n_runs // max(1, jobs)))
+
+# forked runs pay for the shared prefix once per prefix run instead of once per run
+total_cost = forecast["cost"] * n_runs
+if fork_after:
+    prefix_cost = forecast_df[forecast_df["prompt"].isin(prefix_names)]["cost"].sum()
+    total_cost = prefix_cost * prefix_runs + (forecast["cost"] - prefix_cost) * n_runs
+    print(f"Forked: {prefix_runs} prefix runs + {n_runs} branches: ${total_cost:.4f} (${forecast['cost'] * n_runs:.4f} without forking)")
+
+if dry_run:
     sys.exit(0)
 
+if budget_arg is not None:
+    budget = budget_arg
+elif forecast_config.get("budget") is not None:
+    budget = forecast_config["budget"] * n_runs
+else:
+    budget = None
+if budget is not None and total_cost > budget:
+    print(f"Projected cost ${total_cost:.4f} exceeds the budget of ${budget:.4f}. Not starting.")
+    sys.exit(1)
+
+if not skip_confirm:
+    user_input = input("\nPress Enter to continue or 'q' to quit: ")
+    if user_input.lower() == 'q':
+        print("Operation cancelled by user.")
+        sys.exit(0)
+
 print("\nProceeding with paper generation...")
 
 #%% Run the paper generation multiple times
-for run_id in range(run_start, run_end + 1):
-    print(f"\n=== Starting Run {run_id:02d} of {run_end} ===")
-    
-    # Run make-paper.py and capture output
-    result = subprocess.run(["python", "-u", "make-paper.py", "--plan_name", plan_name])
+
+def fresh_folder(name):
+    # each run writes straight into its own folder (padded with zeros)
+    folder = os.path.join(detail_folder, name, "")
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+    os.makedirs(folder)
+    return folder
+
+def prefix_label(run_id):
+    # runs are spread over the prefix runs in turn
+    return f"prefix{(run_id - run_start) % prefix_runs + 1:02d}"
+
+def run_make_paper(label, folder, extra_args=()):
+    command = ["python", "-u", "make-paper.py", "--plan_name", plan_name, "--output_folder", folder, *extra_args]
+
+    if jobs == 1:
+        result = subprocess.run(command)
+    else:
+        # runs in parallel would interleave on the console, so each run gets its own console log
+        with open(os.path.join(folder, "console.txt"), "w", encoding="utf-8") as console:
+            result = subprocess.run(command, stdout=console, stderr=subprocess.STDOUT)
 
     # Print the components of result
-    print("\nProcess Results:")
+    print(f"\nProcess Results ({label}):")
     print(f"Return Code: {result.returncode}")
     print(f"Command Run: {result.args}")
-    
-    # Create new output folder name with run ID (padded with zeros)
-    run_detail_folder = os.path.join(detail_folder, f"run{run_id:02d}")
+    print(f"Completed {label}. Output saved to {folder}")
+
+    return result.returncode
+
+def run_prefix(prefix_id):
+    print(f"\n=== Starting Prefix {prefix_id:02d} of {prefix_runs} ===")
+    last_step = execution_plan["indices"][fork_after - 1] + 1
+    return run_make_paper(f"prefix{prefix_id:02d}", fresh_folder(f"prefix{prefix_id:02d}"), ["--last_step", str(last_step)])
 
-    # pause to allow dropbox sync
-    time.sleep(10)    
+def run_paper(run_id):
+    print(f"\n=== Starting Run {run_id:02d} of {run_end} ===")
+    run_detail_folder = fresh_folder(f"run{run_id:02d}")
+    if fork_after:
+        # make-paper.py skips the prefix steps, they are current in the manifest
+        fork_run_folder(execution_plan, os.path.join(detail_folder, prefix_label(run_id), ""), run_detail_folder, prefix_names)
+    return run_make_paper(f"run {run_id:02d}", run_detail_folder)
+
+def run_batch(run_folders, indices):
+    # Runs the steps for all runs in this process, one step at a time: step k of every run
+    # goes out as one Message Batch, then all runs move on to step k+1
+    config, prompts = execution_plan["config"], execution_plan["prompts"]
+    prompt_deps = execution_plan["deps"]
+    prompt_context = execution_plan["context"]
+
+    # a run whose step fails (after retries and fallback models) is dropped, the other runs go on
+    failed_runs = {}
+
+    def run_step_all_runs(index):
+        active_labels = [label for label in run_folders if label not in failed_runs]
+        print(f"\n=== Step {prompts[index]['name']} for {len(active_labels)} runs ===")
+        steps = {
+            label: prepare_step(prompts, index, config, run_folders[label], prompt_context[prompts[index]["name"]])
+            for label in active_labels
+        }
+        for label, step in steps.items():
+            save_step_prompt(step, run_folders[label])
+
+        llmdats = {}
+        if MODEL_CONFIG[prompts[index]["model_name"]]["type"] == "anthropic" and steps:
+            results = batch_query_claude({
+                label: {
+                    "model_name": step["model_name"],
+                    "full_prompt": step["prompt_blocks"],
+                    "system_prompt": step["system_prompt"],
+                    "max_tokens": step["max_tokens"],
+                    "thinking_budget": step["thinking_budget"],
+                    "temperature": step["temperature"],
+                    "ledger": {"run": step["run"], "prompt": step["name"], "operation": "Main"}
+                }
+                for label, step in steps.items()
+            }, poll_seconds=poll_seconds)
+            llmdats = {label: results[label] for label in active_labels if label in results}
+
+        # other models, and batch requests that failed, get ordinary concurrent requests
+        # (only Claude supports message batches here)
+        remaining = {label: step for label, step in steps.items() if label not in llmdats}
+        if remaining:
+            with ThreadPoolExecutor(max_workers=len(remaining)) as executor:
+                futures = {label: submit_in_context(executor, query_step, step, False) for label, step in remaining.items()}
+                for label, future in futures.items():
+                    if future.exception() is not None:
+                        logging.error(f"{label} failed at {prompts[index]['name']}: {future.exception()}")
+                        failed_runs[label] = future.exception()
+                    else:
+                        llmdats[label] = future.result()
+
+        for label, step in steps.items():
+            if label in llmdats:
+                finish_step(prompts, step, llmdats[label], config, run_folders[label])
+
+    # steps run one after another in dependency order
+    with ledger_context(plan=plan_name):
+        run_prompt_dag(
+            prompts,
+            run_step_all_runs,
+            indices=indices,
+            deps=prompt_deps,
+            priority=critical_path_priority(prompts, prompt_deps, {prompt["name"]: 1 for prompt in prompts}),
+            max_concurrency=1
+        )
 
-    if os.path.exists(run_detail_folder):
-        shutil.rmtree(run_detail_folder)
-    shutil.copytree(f"output{temp_num}-{temp_name}/", run_detail_folder)
-    
-    if result.returncode != 0:
-        raise RuntimeError(f"make-paper.py failed with return code {result.returncode}")
-    
-    print(f"Completed run {run_id:02d}. Output saved to {run_detail_folder}")
+    last_prompt_name = prompts[indices[-1]]['name']
+    if "full-paper" in last_prompt_name:
+        for label in run_folders:
+            if label not in failed_runs:
+                compile_full_paper(plan_name, last_prompt_name, run_folders[label])
+
+    # the cost report make-paper.py writes for each run (the ledger has the batch prices)
+    for label in run_folders:
+        save_all_costs(run_folders[label])
+
+    return failed_runs
+
+run_ids = list(range(run_start, run_end + 1))
+prefix_ids = list(range(1, prefix_runs + 1)) if fork_after else []
+if batch_mode:
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.FileHandler(os.path.join(detail_folder, "batch_generation.log")),
+            logging.StreamHandler(sys.stdout)
+        ]
+    )
+
+    failed_prefixes = {}
+    run_indices = execution_plan["indices"]
+    if fork_after:
+        prefix_folders = {f"prefix{prefix_id:02d}": fresh_folder(f"prefix{prefix_id:02d}") for prefix_id in prefix_ids}
+        failed_prefixes = run_batch(prefix_folders, run_indices[:fork_after])
+        run_indices = run_indices[fork_after:]
+
+    run_folders = {}
+    failed_runs = {}
+    for run_id in run_ids:
+        label = f"run{run_id:02d}"
+        if fork_after and prefix_label(run_id) in failed_prefixes:
+            failed_runs[label] = f"{prefix_label(run_id)} failed"
+            continue
+        run_folders[label] = fresh_folder(label)
+        if fork_after:
+            fork_run_folder(execution_plan, prefix_folders[prefix_label(run_id)], run_folders[label], prefix_names)
+    failed_runs.update(run_batch(run_folders, run_indices))
+else:
+    # all runs share the rate limit state in ./temp/, so parallel runs pace each other
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        # the shared prefixes first (if forking), then the runs that branch from them
+        prefix_codes = dict(zip([f"prefix{prefix_id:02d}" for prefix_id in prefix_ids], executor.map(run_prefix, prefix_ids)))
+        failed_runs = {
+            f"run{run_id:02d}": f"{prefix_label(run_id)} failed"
+            for run_id in run_ids if fork_after and prefix_codes[prefix_label(run_id)] != 0
+        }
+        branch_ids = [run_id for run_id in run_ids if f"run{run_id:02d}" not in failed_runs]
+        return_codes = dict(zip(branch_ids, executor.map(run_paper, branch_ids)))
+
+    failed_runs.update({f"run{run_id:02d}": f"make-paper.py return code {code}" for run_id, code in return_codes.items() if code != 0})
 
 #%% Copy PDFs to output folder
 
@@ -101,3 +324,7 @@ for run_id in range(run_start, run_end + 1):
 print("\nAll runs completed!")
 print(f"All PDFs have been copied to {pdf_folder}")
 print(f"All detailed outputs are in {detail_folder}")
+
+# report failed runs last, after the PDFs of the good runs are saved
+if failed_runs:
+    raise RuntimeError(f"Runs {sorted(failed_runs)} failed: {'; '.join(f'{label}: {error}' for label, error in sorted(failed_runs.items()))}")
@@ -3,20 +3,18 @@
 
 import os
 import sys
-import replicate
 from dotenv import load_dotenv
-from datetime import datetime
-import pandas as pd
-from utils import MODEL_CONFIG, print_wrapped, assemble_prompt, query_claude, query_openai, response_to_texinput, texinput_to_pdf
+from datetime import datetime, timezone
 
 load_dotenv()
 
-from utils import save_costs, aggregate_costs, is_jupyter
-import yaml
+from utils import save_all_costs, metrics_summary, is_jupyter, ledger_context
+from utils import compile_plan, critical_path_priority, run_prompt_dag
+from utils import CACHE_MODES, configure_cache
+from utils import prepare_step, save_step_prompt, query_step, finish_step, step_is_current, current_steps
+from utils import forecast_plan, print_forecast
 import logging
 from importlib import reload
-import re
-import time
 import argparse
 
 
@@ -27,18 +25,46 @@ plan_default = "plan0408-piecewise"
 if is_jupyter():
     # User
     plan_name = plan_default
+    max_concurrency_arg = None
+    cache_mode_arg = None
+    output_folder_arg = None
+    force_rerun = False
+    dry_run = False
+    budget_arg = None
+    last_step_arg = None
 else:
     parser = argparse.ArgumentParser(description="Generate a paper from a plan")
     parser.add_argument("--plan_name", type=str, default=plan_default, help="Name of the plan to use")
+    parser.add_argument("--max_concurrency", type=int, default=None, help="Maximum number of independent prompts to run at once (overrides the plan config)")
+    parser.add_argument("--cache_mode", type=str, default=None, choices=CACHE_MODES, help="LLM response cache mode (default: off, or $LLM_CACHE_MODE)")
+    parser.add_argument("--output_folder", type=str, default=None, help="Folder for the outputs (default: ./output{num}-{name}/)")
+    parser.add_argument("--force", action="store_true", help="Rerun every step in the run range, even if its inputs are unchanged")
+    parser.add_argument("--dry_run", "--dry-run", action="store_true", help="Print the projected tokens, cost and time of each step, then stop")
+    parser.add_argument("--budget", type=float, default=None, help="Refuse to run if the projected cost (USD) is higher (default: budget in the plan config)")
+    parser.add_argument("--last_step", type=int, default=None, help="Stop after this prompt number (default: the end of the plan's run range)")
     args = parser.parse_args()
     plan_name = args.plan_name
+    max_concurrency_arg = args.max_concurrency
+    cache_mode_arg = args.cache_mode
+    output_folder_arg = args.output_folder
+    force_rerun = args.force
+    dry_run = args.dry_run
+    budget_arg = args.budget
+    last_step_arg = args.last_step
+
+# Set up the response cache
+configure_cache(mode=cache_mode_arg)
 
 #%% 
 # Set up folder and loops
 
 # Define and set up output folder
 temp_num, temp_name = plan_name.split("plan")[1].split("-") 
-output_folder = f"./output{temp_num}-{temp_name}/"
+if output_folder_arg:
+    # file names are built by appending to the folder, so make sure it ends with a slash
+    output_folder = os.path.join(output_folder_arg, "")
+else:
+    output_folder = f"./output{temp_num}-{temp_name}/"
 if not os.path.exists(output_folder):
     os.makedirs(output_folder)
 
@@ -55,17 +81,66 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 logger.info(f"Starting paper generation for plan: {plan_name}")
 
-# Load all config and prompts
-with open(f"{plan_name}.yaml", "r") as f:
-    temp = yaml.safe_load(f)
+# all-costs.txt also reports the cost of the LLM calls from here on (this execution)
+run_started = datetime.now(timezone.utc).isoformat()
 
-config = temp["config"]
-prompts = temp["prompts"]
+# Load all config and prompts, and check the whole plan before any model call
+# (unknown models, token limits, missing lit/latex files); saved as execution-plan.json
+execution_plan = compile_plan(plan_name, output_folder)
+config, prompts = execution_plan["config"], execution_plan["prompts"]
 
 # Initialize
-all_costs = []
 index_start = config["run_range"]["start"]-1
 index_end = min(config["run_range"]["end"]-1, len(prompts)-1)
+if last_step_arg is not None:
+    # e.g. the shared prefix of forked runs (make-many-papers.py --fork_after)
+    index_end = min(index_end, last_step_arg-1)
+max_concurrency = max_concurrency_arg or config.get("max_concurrency", 1)
+
+#%%
+# DEFINE PROMPT RUNNER
+
+# The prompt dependency graph (default: each prompt depends on all previous prompts)
+# and the earlier responses each prompt gets as context (default: all it depends on)
+prompt_deps = execution_plan["deps"]
+prompt_context = execution_plan["context"]
+
+def run_prompt(index):
+    # Assemble the prompt, with the selected earlier responses as context
+    step = prepare_step(prompts, index, config, output_folder, prompt_context[prompts[index]["name"]])
+
+    # skip the step if it already ran with exactly these inputs (Make-style)
+    if not force_rerun and step_is_current(output_folder, step["name"], step["input_hash"]):
+        logger.info(f"Skipping {step['name']}: inputs unchanged since the last run")
+        return
+
+    # save the prompt, query the model, then save the response, latex and costs
+    save_step_prompt(step, output_folder)
+    llmdat = query_step(step, echo=max_concurrency == 1)
+    finish_step(prompts, step, llmdat, config, output_folder)
+
+#%%
+# FORECAST TOKENS, COST AND TIME (counted locally, no model calls)
+
+# steps that already ran with exactly these inputs are skipped below, so they cost nothing
+run_indices = list(range(index_start, index_end+1))
+skipped_names = [] if force_rerun else current_steps(execution_plan, run_indices, output_folder)
+if skipped_names:
+    logger.info(f"{len(skipped_names)} steps are current and will be skipped: {', '.join(skipped_names)}")
+
+forecast_df, forecast = forecast_plan(
+    plan_name, config, prompts, [index for index in run_indices if prompts[index]["name"] not in skipped_names], output_folder, max_concurrency
+)
+print_forecast(forecast_df, forecast)
+
+if dry_run:
+    logger.info("Dry run, stopping before any model calls")
+    sys.exit(0)
+
+budget = budget_arg if budget_arg is not None else config.get("budget")
+if budget is not None and forecast["cost"] > budget:
+    logger.error(f"Projected cost ${forecast['cost']:.4f} exceeds the budget of ${budget:.4f}")
+    sys.exit(1)
 
 #%%
 # LOOP OVER PROMPTS
@@ -73,230 +148,47 @@ index_end = min(config["run_range"]["end"]-1, len(prompts)-1)
 # feedback
 logger.info("==== FEEDBACK ====")
 logger.info(f"Running plan {plan_name} from prompt {index_start+1} to prompt {index_end+1}")
-
-# loop over prompts
-for index in range(index_start, index_end+1):    
-# for index in [0]:
-    
-    logger.info("==== FEEDBACK ====")
-    logger.info(f"Processing prompt number {index+1}...")
-    logger.info(f"Instructions: {prompts[index]['instructions']}")
-
-    if "lit_files" in prompts[index]:
-        logger.info(f"Lit files: {prompts[index]['lit_files']}")
-    
-    # Previous responses context
-    prev_responses = [prompt["name"] for prompt in prompts[:index]]
-    prev_responses = [f"{output_folder}{fname}-response.md" for fname in prev_responses]
-
-    # Literature context
-    if "lit_files" in prompts[index]:
-        lit_files = prompts[index]["lit_files"]
-        lit_files = [f"./lit-context/{fname}" for fname in lit_files]
-    else:
-        lit_files = []
-
-    # LaTeX files
-    if "latex_files" in prompts[index]:
-        latex_files = prompts[index]["latex_files"]
-        latex_files = [f"./latex-input/{fname}" for fname in latex_files]
-    else:
-        latex_files = []
-
-    # Generate the full prompt
-    full_prompt = assemble_prompt(
-        instructions=prompts[index]["instructions"],
-        context_files=prev_responses + lit_files + latex_files
+logger.info(f"Running up to {max_concurrency} independent prompts at once")
+
+# run the prompts, longest chains of the longest steps first
+prompt_weights = {
+    prompt["name"]: prompt.get("max_tokens", config["max_tokens"]) + prompt.get("thinking_budget", config["thinking_budget"])
+    for prompt in prompts
+}
+prompt_priority = critical_path_priority(prompts, prompt_deps, prompt_weights)
+with ledger_context(plan=plan_name):
+    run_prompt_dag(
+        prompts, 
+        run_prompt, 
+        indices=list(range(index_start, index_end+1)), 
+        deps=prompt_deps, 
+        priority=prompt_priority, 
+        max_concurrency=max_concurrency
     )
 
-    # Get max_tokens, thinking_budget, and use_system_prompt from prompt or use defaults
-    max_tokens = prompts[index].get("max_tokens", config["max_tokens"])
-    thinking_budget = prompts[index].get("thinking_budget", config["thinking_budget"])
-    use_system_prompt = prompts[index].get("use_system_prompt", config["use_system_prompt"])
-   
-    # by default, use system prompt
-    if use_system_prompt:
-        system_prompt_current = config["system_prompt"]
-    else:
-        # do not use system prompt if use_system_prompt is false
-        system_prompt_current = ""
-   
-    # save the prompt
-    with open(f"{output_folder}{prompts[index]['name']}-system-prompt.xml", "w", encoding="utf-8") as f:
-        f.write(system_prompt_current)
-    time.sleep(0.1)
-    with open(f"{output_folder}{prompts[index]['name']}-prompt.xml", "w", encoding="utf-8") as f:
-        f.write(full_prompt)
-
-    logger.info("==== FEEDBACK ====")
-    logger.info(f"Querying {prompts[index]['model_name']}")
-
-    # Query the model
-    if MODEL_CONFIG[prompts[index]["model_name"]]["type"] == "anthropic":
-        llmdat = query_claude(
-            model_name=prompts[index]["model_name"],
-            full_prompt=full_prompt,
-            system_prompt=system_prompt_current,
-            max_tokens=max_tokens,
-            temperature=config["temperature"],
-            thinking_budget=thinking_budget
-        )
-    else:
-        llmdat = query_openai(
-            model_name=prompts[index]["model_name"],
-            full_prompt=full_prompt,
-            system_prompt=system_prompt_current,
-            max_tokens=max_tokens,
-        )
-
-    # save the response
-    with open(f"{output_folder}{prompts[index]['name']}-response.md", "w", encoding="utf-8") as f:
-        f.write(llmdat["response"])
-
-
-    if config["convert_all_latex"]:
-        logger.info("==== FEEDBACK ====")
-        logger.info(f"Converting to LaTeX")
-
-        # Convert to LaTeX
-        latex_model = "haiku"
-        par_per_chunk = 5
-        if lit_files == []:
-            bibtex_input = None
-        else:
-            bibtex_input = "./lit-context/bibtex-all.bib"
-
-        llmdat_texinput = response_to_texinput(
-            response_raw=llmdat["response"],
-            par_per_chunk=par_per_chunk,
-            model_name=latex_model,
-            bibtex_raw=bibtex_input
-        )
-
-        # Save texinput
-        texinput_file = f"{output_folder}{prompts[index]['name']}-texinput.tex"
-        with open(texinput_file, 'w', encoding='utf-8') as file:
-            file.write(llmdat_texinput["response"])
-        logger.info(f"LaTeX input saved to {texinput_file}")
-
-        # Convert to PDF    
-        compile_result = texinput_to_pdf(llmdat_texinput["response"], f"{prompts[index]['name']}-latex", output_folder)
-
-        # if the conversion fails, use sonnet to convert to latex
-        if compile_result != 0:
-            logger.warning("LaTeX conversion failed, using sonnet to convert to latex")
-            llmdat_texinput = response_to_texinput(
-                response_raw=llmdat["response"],
-                par_per_chunk=par_per_chunk,
-                model_name="sonnet"
-            )
-            texinput_to_pdf(llmdat_texinput["response"], f"{prompts[index]['name']}-latex", output_folder)    
-
-    else:
-        logger.info("==== FEEDBACK ====")
-        logger.info(f"Skipping LaTeX conversion")
-
-        latex_model = "NA"
-    
-        # create llmdat_texinput with zero costs
-        llmdat_texinput = {
-            "response": "NA",
-            "input_tokens": 0,
-            "output_tokens": 0,
-            "input_cost": 0.0,
-            "output_cost": 0.0,
-            "total_cost": 0.0
-        }
-
-    # here i'm lazy and don't separate the saving
-    save_costs(prompts, index, llmdat, llmdat_texinput, latex_model, output_folder)
-
 #%%
 # Compile Full Paper Latex (if specified in yaml)
 
 # reload for easy modifications
 import utils
 reload(utils)
-from utils import create_readme_appendix, create_appendix
+from utils import compile_full_paper
 
-import shutil
-from utils import tex_to_pdf
-import glob
 last_prompt_name = prompts[index_end]['name']
 
 if "full-paper" in last_prompt_name:
-    logger.info("==== FEEDBACK ====")
-    logger.info(f"Compiling full paper LaTeX")
-
-    # Generate appendix first
-    logger.info("Generating appendix with README...")
-    create_readme_appendix()
-
-    logger.info("Generating appendix with prompt listing...")
-    create_appendix(plan_name + ".yaml")
-
-    # copy latex-inputs to output folder
-    # Copy all .tex files from latex-input to output folder
-    logger.info("Copying .tex files from latex-input to output folder...")
-    for tex_file in glob.glob("latex-input/*.tex"):
-        shutil.copy(tex_file, output_folder)
-    shutil.copy("latex-input/econstyle.sty", output_folder)
-
-    # read in the full paper md response
-    with open(f"{output_folder}{last_prompt_name}-response.md", "r", encoding="utf-8") as f:
-        full_paper_md = f.read()
-
-    # remove everything between \documentclass and \end{document}
-    i_start = full_paper_md.find("\\documentclass")
-    i_end = full_paper_md.find("\\end{document}") + len("\\end{document}")
-    full_paper_md = full_paper_md[i_start:i_end]
-
-    # update "../latex-input/" to "./"
-    full_paper_md = full_paper_md.replace("../latex-input/", "./")
-
-    # save the full paper md
-    with open(f"{output_folder}{last_prompt_name}-cleaned.tex", "w", encoding="utf-8") as f:
-        f.write(full_paper_md)
-
-    # compile the full paper
-    compile_result = tex_to_pdf(f"{last_prompt_name}-cleaned", output_folder)
+    compile_result = compile_full_paper(plan_name, last_prompt_name, output_folder)
 
 #%%
-# AGGREGATE COSTS
-
-import glob
-from io import StringIO
-
-# remove all-costs.txt if it exists
-if os.path.exists(f"{output_folder}all-costs.txt"):
-    os.remove(f"{output_folder}all-costs.txt")
-
-# find all *-costs.txt files
-costs_files = glob.glob(f"{output_folder}*-costs.txt")
+# AGGREGATE COSTS (from the ledger, the calls that produced each step in the output folder)
 
-costs_df = pd.DataFrame()
-for file in costs_files:
-    with open(file, "r", encoding="utf-8") as f:
-        text = f.read()
+save_all_costs(output_folder, since=run_started)
 
-    # remove comma, dollar sign
-    text = text.replace(",", "").replace("$", "")
-
-    # convert to dataframe
-    df = pd.read_csv(StringIO(text), sep=r'\s+')
-
-    # get just the filename without the path
-    file_clean = os.path.basename(file)
-    df.insert(0, 'filename', file_clean)
-
-    # append to costs_df
-    costs_df = pd.concat([costs_df, df])
-    
+#%%
+# LATENCY SUMMARY (from metrics.jsonl: rate limit wait, thinking and generation time per step)
 
-# save costs to file
-grand_total = costs_df['Total_Cost'].sum()
-with open(f"{output_folder}all-costs.txt", "w", encoding="utf-8") as f:
-    f.write(f"Grand Total: ${grand_total:.4f}\n")
-    f.write(costs_df.to_string(index=False))
+metrics_df = metrics_summary(output_folder)
+if not metrics_df.empty:
+    logger.info(f"Latency by step (seconds):\n{metrics_df.to_string(index=False)}")
 
 logger.info(f"Paper generation completed. Log saved to {log_file}")
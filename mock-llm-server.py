@@ -0,0 +1,438 @@
+# Local stand-in for the Anthropic Messages API (streaming and Message Batches) and the OpenAI
+# chat completions API, so plans can be run, tested and benchmarked offline without API keys.
+#
+# Responses are replayed from earlier runs when a recorded prompt has the same instructions
+# (--replay), LaTeX conversion requests get their input document back, and anything else gets
+# a canned response. TTFT, tokens/sec, rate limits and errors are configurable.
+#
+# Start the server, then point the clients at it:
+#   python mock-llm-server.py --port 8765 --batch_seconds 5 --ttft 0.5 --tokens_per_second 100
+#   ANTHROPIC_BASE_URL=http://127.0.0.1:8765 OPENAI_BASE_URL=http://127.0.0.1:8765/v1 ANTHROPIC_API_KEY=mock OPENAI_API_KEY=mock python make-paper.py --plan_name plan0000-test
+#   ANTHROPIC_BASE_URL=http://127.0.0.1:8765 ANTHROPIC_API_KEY=mock python make-many-papers.py --plan_name plan0000-test --batch --yes --poll_seconds 1
+# or run whole plans against it with benchmark-plans.py
+
+#%%
+import argparse
+import glob
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BATCHES = {}
+BATCHES_LOCK = threading.Lock()
+
+# recorded responses by the instructions of their prompt, see load_replay
+REPLAY = {}
+
+# simulated per-minute rate limits (token buckets), shared by all connections
+RATE_LIMITS = {
+    "requests": 4000,
+    "input_tokens": 2000000,
+    "output_tokens": 400000
+}
+BUCKETS = {}
+BUCKETS_LOCK = threading.Lock()
+
+def iso_time(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat().replace("+00:00", "Z")
+
+def estimate_tokens(text):
+    """Rough token count (about 4 characters per token), as in utils.py"""
+    return len(text) // 4 + 1
+
+def prompt_text_from_params(params):
+    """Joins the system prompt and all message text into one string"""
+    parts = []
+    system = params.get("system", "")
+    if isinstance(system, str):
+        parts.append(system)
+    else:
+        parts.extend(block.get("text", "") for block in system)
+    for message in params.get("messages", []):
+        # an assistant prefill is continued, not answered
+        if message["role"] == "assistant":
+            continue
+        content = message["content"]
+        if isinstance(content, str):
+            parts.append(content)
+        else:
+            parts.extend(block.get("text", "") for block in content)
+    return "\n\n".join(parts)
+
+def prefill_from_params(params):
+    """The assistant prefill of a request ("" if there is none)"""
+    messages = params.get("messages", [])
+    if messages and messages[-1]["role"] == "assistant":
+        content = messages[-1]["content"]
+        return content if isinstance(content, str) else "".join(block.get("text", "") for block in content)
+    return ""
+
+def last_instructions(prompt):
+    """The last <instructions> block of a prompt, whitespace normalized (the replay key)"""
+    instructions = re.findall(r"<instructions>\n(.*?)\n</instructions>", prompt, re.DOTALL)
+    return " ".join(instructions[-1].split()) if instructions else None
+
+def load_replay(patterns):
+    """
+    Indexes the responses recorded in output folders: {name}-prompt.xml next to {name}-response.md.
+    The newest recording wins when several runs used the same instructions.
+    Args:
+        patterns (list): Folder globs, e.g. ["output*/", "manyout*-detail/run*/"]
+    Returns:
+        int: Number of recorded responses
+    """
+    prompt_files = []
+    for pattern in patterns:
+        prompt_files += glob.glob(os.path.join(pattern, "*-prompt.xml"))
+    for prompt_file in sorted(prompt_files, key=os.path.getmtime):
+        response_file = prompt_file.replace("-prompt.xml", "-response.md")
+        if prompt_file.endswith("-system-prompt.xml") or not os.path.exists(response_file):
+            continue
+        with open(prompt_file, "r", encoding="utf-8") as f:
+            key = last_instructions(f.read())
+        if key is None:
+            continue
+        with open(response_file, "r", encoding="utf-8") as f:
+            REPLAY[key] = f.read()
+    return len(REPLAY)
+
+def mock_response_text(params):
+    """Recorded response for the instructions if there is one, the input document of a LaTeX conversion, or a canned response"""
+    prompt = prompt_text_from_params(params)
+    key = last_instructions(prompt)
+    if key in REPLAY:
+        return REPLAY[key]
+    document = re.search(r"<input-document>\n(.*?)\n\s*</input-document>", prompt, re.DOTALL)
+    if document:
+        return document.group(1).strip()
+    first_line = key[:200] if key else prompt.strip()[:200]
+    return f"Mock response from {params.get('model')}.\n\nInstructions: {first_line}\n"
+
+def response_tokens(params):
+    """
+    Splits the response into stream chunks of about one token, continuing after any prefill
+    and cut off at max_tokens
+    Returns:
+        (list, str): Chunks and stop reason
+    """
+    text = mock_response_text(params)
+    prefill = prefill_from_params(params)
+    if prefill and text.startswith(prefill):
+        text = text[len(prefill):]
+    chunks = re.findall(r"\s*\S{1,4}|\s+$", text)
+    max_tokens = params.get("max_tokens") or params.get("max_completion_tokens") or len(chunks)
+    if len(chunks) > max_tokens:
+        return chunks[:max_tokens], "max_tokens"
+    return chunks, "end_turn"
+
+def mock_usage(params, chunks):
+    return {
+        "input_tokens": estimate_tokens(prompt_text_from_params(params) + prefill_from_params(params)),
+        "output_tokens": len(chunks),
+        "cache_creation_input_tokens": 0,
+        "cache_read_input_tokens": 0
+    }
+
+def mock_message(params):
+    """Builds an Anthropic Message object for the request parameters"""
+    chunks, stop_reason = response_tokens(params)
+    return {
+        "id": f"msg_mock_{uuid.uuid4().hex[:24]}",
+        "type": "message",
+        "role": "assistant",
+        "model": params.get("model"),
+        "content": [{"type": "text", "text": "".join(chunks)}],
+        "stop_reason": stop_reason,
+        "stop_sequence": None,
+        "usage": mock_usage(params, chunks)
+    }
+
+def take_ratelimit(provider, needed):
+    """
+    Debits a request from the simulated per-minute buckets
+    Returns:
+        (dict, float): Remaining budget per bucket, and seconds to wait if the request is over the limit (0 if not)
+    """
+    with BUCKETS_LOCK:
+        now = time.time()
+        buckets = BUCKETS.setdefault(provider, {"available": dict(RATE_LIMITS), "updated": now})
+        elapsed = now - buckets["updated"]
+        for bucket, limit in RATE_LIMITS.items():
+            buckets["available"][bucket] = min(limit, buckets["available"][bucket] + limit * elapsed / 60)
+        buckets["updated"] = now
+
+        retry_after = 0.0
+        for bucket, amount in needed.items():
+            shortfall = min(amount, RATE_LIMITS[bucket]) - buckets["available"][bucket]
+            if shortfall > 0:
+                retry_after = max(retry_after, shortfall / (RATE_LIMITS[bucket] / 60))
+        if retry_after == 0:
+            for bucket, amount in needed.items():
+                buckets["available"][bucket] -= min(amount, RATE_LIMITS[bucket])
+        return {bucket: int(max(0, value)) for bucket, value in buckets["available"].items()}, retry_after
+
+def ratelimit_headers(provider, remaining):
+    """Rate limit headers in the format of each provider"""
+    if provider == "anthropic":
+        headers = {}
+        for bucket in ["requests", "input_tokens", "output_tokens"]:
+            name = bucket.replace("_", "-")
+            headers[f"anthropic-ratelimit-{name}-limit"] = str(RATE_LIMITS[bucket])
+            headers[f"anthropic-ratelimit-{name}-remaining"] = str(remaining[bucket])
+        return headers
+    return {
+        "x-ratelimit-limit-requests": str(RATE_LIMITS["requests"]),
+        "x-ratelimit-remaining-requests": str(remaining["requests"]),
+        "x-ratelimit-limit-tokens": str(RATE_LIMITS["input_tokens"] + RATE_LIMITS["output_tokens"]),
+        "x-ratelimit-remaining-tokens": str(remaining["input_tokens"] + remaining["output_tokens"])
+    }
+
+def batch_object(batch, base_url):
+    """Builds the MessageBatch object, ended once batch_seconds have passed"""
+    ended = time.time() >= batch["ends_at"]
+    count = len(batch["requests"])
+    return {
+        "id": batch["id"],
+        "type": "message_batch",
+        "processing_status": "ended" if ended else "in_progress",
+        "request_counts": {
+            "processing": 0 if ended else count,
+            "succeeded": count if ended else 0,
+            "errored": 0,
+            "canceled": 0,
+            "expired": 0
+        },
+        "created_at": iso_time(batch["created_at"]),
+        "expires_at": iso_time(batch["created_at"] + 24*3600),
+        "ended_at": iso_time(batch["ends_at"]) if ended else None,
+        "archived_at": None,
+        "cancel_initiated_at": None,
+        "results_url": f"{base_url}/v1/messages/batches/{batch['id']}/results" if ended else None
+    }
+
+class MockHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 keeps connections alive (as the real APIs do) and allows chunked streams
+    protocol_version = "HTTP/1.1"
+    batch_seconds = 5.0
+    ttft = 0.0
+    tokens_per_second = 0.0
+    error_rate = 0.0
+    drop_rate = 0.0
+    quiet = False
+
+    def log_message(self, format, *args):
+        if not self.quiet:
+            super().log_message(format, *args)
+
+    def base_url(self):
+        return f"http://{self.headers.get('Host')}"
+
+    def send_json(self, status, data, content_type="application/json", headers=None):
+        body = data if isinstance(data, bytes) else json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, provider, status, error_type, message, headers=None):
+        if provider == "anthropic":
+            error = {"type": "error", "error": {"type": error_type, "message": message}}
+        else:
+            error = {"error": {"type": error_type, "message": message, "code": None, "param": None}}
+        self.send_json(status, error, headers=headers)
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def admit(self, provider, params, chunks):
+        """
+        Applies the simulated rate limits and injected errors
+        Returns:
+            dict: Rate limit headers for the response, or None if an error was sent instead
+        """
+        remaining, retry_after = take_ratelimit(provider, {
+            "requests": 1,
+            "input_tokens": mock_usage(params, chunks)["input_tokens"],
+            "output_tokens": len(chunks)
+        })
+        headers = ratelimit_headers(provider, remaining)
+        if retry_after > 0:
+            headers["retry-after"] = str(int(retry_after) + 1)
+            self.send_error_json(provider, 429, "rate_limit_error", "Mock rate limit exceeded", headers=headers)
+            return None
+        if random.random() < self.error_rate:
+            if provider == "anthropic":
+                self.send_error_json(provider, 529, "overloaded_error", "Mock overloaded")
+            else:
+                self.send_error_json(provider, 500, "server_error", "Mock server error")
+            return None
+        return headers
+
+    def generation_pause(self, n_chunks):
+        if self.tokens_per_second > 0:
+            time.sleep(n_chunks / self.tokens_per_second)
+
+    def send_event(self, name, data):
+        chunk = f"event: {name}\ndata: {json.dumps(data)}\n\n".encode("utf-8")
+        self.wfile.write(f"{len(chunk):x}\r\n".encode("utf-8") + chunk + b"\r\n")
+        self.wfile.flush()
+
+    def stream_message(self, params, chunks, stop_reason, headers):
+        """Streams a Message as server-sent events, paced by ttft and tokens_per_second"""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+
+        message = mock_message(params)
+        message.update({"content": [], "stop_reason": None})
+        message["usage"]["output_tokens"] = 1
+        self.send_event("message_start", {"type": "message_start", "message": message})
+        self.send_event("content_block_start", {"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}})
+        time.sleep(self.ttft)
+
+        # a dropped connection cuts the stream halfway through the text
+        drop_at = len(chunks) // 2 if random.random() < self.drop_rate else None
+        for i, text in enumerate(chunks):
+            if i == drop_at:
+                self.close_connection = True
+                self.connection.shutdown(2)
+                return
+            self.send_event("content_block_delta", {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": text}})
+            self.generation_pause(1)
+
+        self.send_event("content_block_stop", {"type": "content_block_stop", "index": 0})
+        self.send_event("message_delta", {
+            "type": "message_delta",
+            "delta": {"stop_reason": stop_reason, "stop_sequence": None},
+            "usage": {"output_tokens": len(chunks)}
+        })
+        self.send_event("message_stop", {"type": "message_stop"})
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def post_message(self):
+        params = self.read_json()
+        chunks, stop_reason = response_tokens(params)
+        headers = self.admit("anthropic", params, chunks)
+        if headers is None:
+            return
+        if params.get("stream"):
+            self.stream_message(params, chunks, stop_reason, headers)
+        else:
+            time.sleep(self.ttft)
+            self.generation_pause(len(chunks))
+            self.send_json(200, mock_message(params), headers=headers)
+
+    def post_chat_completion(self):
+        params = self.read_json()
+        chunks, stop_reason = response_tokens(params)
+        headers = self.admit("openai", params, chunks)
+        if headers is None:
+            return
+        time.sleep(self.ttft)
+        self.generation_pause(len(chunks))
+        input_tokens = mock_usage(params, chunks)["input_tokens"]
+        self.send_json(200, {
+            "id": f"chatcmpl-mock{uuid.uuid4().hex[:24]}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": params.get("model"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": "".join(chunks), "refusal": None},
+                "finish_reason": "length" if stop_reason == "max_tokens" else "stop",
+                "logprobs": None
+            }],
+            "usage": {
+                "prompt_tokens": input_tokens,
+                "completion_tokens": len(chunks),
+                "total_tokens": input_tokens + len(chunks),
+                "prompt_tokens_details": {"cached_tokens": 0}
+            }
+        }, headers=headers)
+
+    def do_POST(self):
+        path = self.path.split("?")[0]
+        if path == "/v1/messages":
+            self.post_message()
+        elif path == "/v1/chat/completions":
+            self.post_chat_completion()
+        elif path == "/v1/messages/batches":
+            data = self.read_json()
+            now = time.time()
+            batch = {
+                "id": f"msgbatch_mock_{uuid.uuid4().hex[:24]}",
+                "requests": data["requests"],
+                "created_at": now,
+                "ends_at": now + self.batch_seconds
+            }
+            with BATCHES_LOCK:
+                BATCHES[batch["id"]] = batch
+            self.send_json(200, batch_object(batch, self.base_url()))
+        else:
+            self.read_json()
+            self.send_json(404, {"type": "error", "error": {"type": "not_found_error", "message": path}})
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        match = re.fullmatch(r"/v1/messages/batches/([^/]+)(/results)?", path)
+        batch = BATCHES.get(match.group(1)) if match else None
+        if batch is None:
+            self.send_json(404, {"type": "error", "error": {"type": "not_found_error", "message": path}})
+        elif match.group(2):
+            lines = [
+                json.dumps({
+                    "custom_id": request["custom_id"],
+                    "result": {"type": "succeeded", "message": mock_message(request["params"])}
+                })
+                for request in batch["requests"]
+            ]
+            self.send_json(200, ("\n".join(lines) + "\n").encode("utf-8"), content_type="application/binary")
+        else:
+            self.send_json(200, batch_object(batch, self.base_url()))
+
+#%%
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the Anthropic Messages and OpenAI chat completions APIs")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Host to listen on")
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on")
+    parser.add_argument("--batch_seconds", type=float, default=5.0, help="Seconds until a batch ends")
+    parser.add_argument("--replay", type=str, nargs="*", default=["output*/", "manyout*-detail/run*/"], help="Output folders (globs) to replay recorded responses from")
+    parser.add_argument("--ttft", type=float, default=0.0, help="Seconds before the first token")
+    parser.add_argument("--tokens_per_second", type=float, default=0.0, help="Output tokens per second of each response (0 for no delay)")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="Fraction of requests answered with 529 overloaded (Anthropic) or 500 (OpenAI)")
+    parser.add_argument("--drop_rate", type=float, default=0.0, help="Fraction of streams whose connection drops halfway")
+    parser.add_argument("--rpm", type=int, default=RATE_LIMITS["requests"], help="Requests per minute before 429s")
+    parser.add_argument("--itpm", type=int, default=RATE_LIMITS["input_tokens"], help="Input tokens per minute before 429s")
+    parser.add_argument("--otpm", type=int, default=RATE_LIMITS["output_tokens"], help="Output tokens per minute before 429s")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed for the injected errors")
+    parser.add_argument("--quiet", action="store_true", help="Do not log each request")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    RATE_LIMITS.update({"requests": args.rpm, "input_tokens": args.itpm, "output_tokens": args.otpm})
+    MockHandler.batch_seconds = args.batch_seconds
+    MockHandler.ttft = args.ttft
+    MockHandler.tokens_per_second = args.tokens_per_second
+    MockHandler.error_rate = args.error_rate
+    MockHandler.drop_rate = args.drop_rate
+    MockHandler.quiet = args.quiet
+    print(f"Replaying {load_replay(args.replay)} recorded responses")
+
+    server = ThreadingHTTPServer((args.host, args.port), MockHandler)
+    server.daemon_threads = True
+    print(f"Mock LLM server listening on http://{args.host}:{args.port}", flush=True)
+    server.serve_forever()
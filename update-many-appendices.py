@@ -11,10 +11,25 @@ import yaml
 import argparse
 import glob
 import re
-from utils import create_readme_appendix, create_appendix, tex_to_pdf
-import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from utils import create_readme_appendix, create_appendix, refresh_full_paper, is_jupyter
 
-plan_name = "plan0408-piecewise"
+plan_default = "plan0408-piecewise"
+
+if is_jupyter():
+    plan_name = plan_default
+    max_workers = os.cpu_count()
+    force_rebuild = False
+else:
+    parser = argparse.ArgumentParser(description="Update the appendices and recompile the full paper in every run folder")
+    parser.add_argument("--plan_name", type=str, default=plan_default, help="Name of the plan to use")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of run folders to compile at once")
+    parser.add_argument("--force", action="store_true", help="Recompile every run folder, even if its inputs are unchanged")
+    args = parser.parse_args()
+    plan_name = args.plan_name
+    max_workers = args.workers
+    force_rebuild = args.force
 
 #%%
 # Update appendices once for all output folders
@@ -39,7 +54,7 @@ pdf_folder = f"./manyout{temp_num}-pdf/"
 if not os.path.exists(pdf_folder):
     os.makedirs(pdf_folder)
 
-run_folders = glob.glob(detail_folder + "/run*/")
+run_folders = sorted(glob.glob(detail_folder + "/run*/"))
 
 # Find the last prompt name from the plan
 with open(f"{plan_name}.yaml", "r") as f:
@@ -48,75 +63,33 @@ prompts = temp["prompts"]
 last_prompt_name = prompts[-1]['name']
 
 #%%
-# Process each run folder
-for run_folder in run_folders:
-    print(f"\n==== Processing folder: {run_folder} ====")
-    
-    # Extract run number from folder name
+# Rebuild the run folders in parallel
+# The builds run in pdflatex/biber child processes, so a thread pool keeps every core busy.
+# Folders whose response and LaTeX inputs are unchanged since their last good build are skipped.
+
+def refresh_run(run_folder):
     run_match = re.search(r'run(\d+)', run_folder)
     if not run_match:
-        print(f"Warning: Could not extract run number from {run_folder}. Skipping this folder.")
-        continue
-    
-    run_number = run_match.group(1)
-    
-    # Check if the response file exists
-    response_file = f"{run_folder}{last_prompt_name}-response.md"
-    if not os.path.exists(response_file):
-        print(f"Warning: Response file {response_file} not found. Skipping this folder.")
-        continue
-
-    print(f"Copying latex input files to {run_folder}")
-    for tex_file in glob.glob("latex-input/*.tex"):
-        shutil.copy(tex_file, run_folder)
-    # shutil.copy("latex-input/econstyle.sty", run_folder)
-    shutil.copy("lit-context/bibtex-all.bib", run_folder)
-
-    # argh, econstyle.sty needs to be modified for its relative path
-    # I should make this more consistent throughout the codebase someday
-    with open("latex-input/econstyle.sty", "r", encoding="utf-8") as f:
-        econstyle_content = f.read()
-    econstyle_content = econstyle_content.replace("../lit-context/", "./")
-    with open(f"{run_folder}econstyle.sty", "w", encoding="utf-8") as f:
-        f.write(econstyle_content)    
-    
-    print(f"Cleaning up response file and making {last_prompt_name}-cleaned.tex file")
-    with open(response_file, "r", encoding="utf-8") as f:
-        full_paper_md = f.read()
-    
-    # Extract LaTeX content
-    i_start = full_paper_md.find("\\documentclass")
-    i_end = full_paper_md.find("\\end{document}") + len("\\end{document}")
-    if i_start == -1 or i_end == -1:
-        print(f"Warning: Could not find LaTeX document markers in {response_file}. Skipping this folder.")
-        continue
-    
-    full_paper_md = full_paper_md[i_start:i_end]
-    
-    # Update "../latex-input/" to "./"
-    full_paper_md = full_paper_md.replace("../latex-input/", "./")
-    
-    tex_file = f"{run_folder}{last_prompt_name}-cleaned.tex"
-    with open(tex_file, "w", encoding="utf-8") as f:
-        f.write(full_paper_md)
-    
-    print(f"Compiling full paper LaTeX for {run_folder}")
+        return {"run_folder": run_folder, "status": "failed", "seconds": 0.0, "errors": ["could not extract the run number"], "passes": []}
     run_folder_linux = run_folder.replace("\\", "/")
-    compile_result = tex_to_pdf(f"{last_prompt_name}-cleaned", run_folder_linux)
-    
-    if compile_result != 0:
-        print(f"Warning: LaTeX compilation failed with error code {compile_result}")
-        continue
-    
-    # Copy the PDF from the run folder to the PDF folder with special suffix
-    source_pdf = f"{run_folder}{last_prompt_name}-cleaned.pdf"
-    dest_pdf = f"{pdf_folder}paper-run{run_number}.pdf"
-    
-    if os.path.exists(source_pdf):
-        print(f"Copying {source_pdf} to {dest_pdf}")
-        shutil.copy2(source_pdf, dest_pdf)
-    else:
-        print(f"Warning: PDF file {source_pdf} not found. Skipping copy.")
+    dest_pdf = f"{pdf_folder}paper-run{run_match.group(1)}.pdf"
+    return refresh_full_paper(run_folder_linux, last_prompt_name, dest_pdf, force=force_rebuild)
+
+time_start = time.time()
+with ThreadPoolExecutor(max_workers=max_workers) as executor:
+    results = list(executor.map(refresh_run, run_folders))
 
 #%%
+# Report timings and failures
+print("\n==== Summary ====")
+for result in results:
+    passes = ", ".join(p["tool"] for p in result["passes"])
+    print(f"{result['run_folder']:<40} {result['status']:<8} {result['seconds']:6.1f}s  {passes}")
+
+failed = [result for result in results if result["status"] == "failed"]
+for result in failed:
+    print(f"FAILED {result['run_folder']}: {'; '.join(result['errors'])}")
+
+counts = {status: sum(result["status"] == status for result in results) for status in ["built", "skipped", "failed"]}
+print(f"\nBuilt {counts['built']}, skipped {counts['skipped']}, failed {counts['failed']} in {time.time() - time_start:.1f}s")
 print("\n==== All processing complete ====") 
@@ -6,14 +6,33 @@ import os
 import textwrap
 import pandas as pd
 import anthropic
-from openai import OpenAI
+import openai
+from openai import OpenAI, AsyncOpenAI
 import glob
 import time
 import re
 import yaml
+import markdown
+from html.parser import HTMLParser
 from IPython import get_ipython
 from datetime import datetime, timezone
 import logging
+import json
+import hashlib
+import fnmatch
+import random
+import threading
+import shutil
+import subprocess
+import sqlite3
+import contextvars
+import asyncio
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
 
 def print_wrapped(text, width=70):
     """
@@ -51,31 +70,788 @@ MODEL_CONFIG = {
         "output": 15.0*10**-6,  # $15 per M tokens
         "type": "anthropic",
         "full_name": "claude-3-7-sonnet-20250219",
-        "max_output_tokens": 64000
+        "max_output_tokens": 64000,
+        "thinking": True,  # supports extended thinking (thinking_budget > 0)
+        "cache_write": 3.75*10**-6,  # prompt caching: 1.25x input to write
+        "cache_read":  0.30*10**-6   # 0.1x input to read
     },
     "haiku": {
         "input": 0.8*10**-6,   
         "output": 4.0*10**-6,
         "type": "anthropic",
         "full_name": "claude-3-5-haiku-20241022",
-        "max_output_tokens": 8192
+        "max_output_tokens": 8192,
+        "thinking": False,
+        "cache_write": 1.0*10**-6,
+        "cache_read": 0.08*10**-6
     },
     "o1": {
         "input": 15.0*10**-6,   
         "output": 60.0*10**-6,  
         "type": "openai",
         "full_name": "o1",
-        "max_output_tokens": 8192
+        "max_output_tokens": 100000,  # includes the reasoning tokens
+        "thinking": False,  # reasons on its own, no thinking budget
+        "cache_write": 15.0*10**-6,  # openai caches automatically, no write premium
+        "cache_read": 7.50*10**-6
     },
     "o3-mini": {
         "input":   1.10*10**-6,   
         "output": 4.40*10**-6,  
         "type": "openai",
         "full_name": "o3-mini",
-        "max_output_tokens": 8192
+        "max_output_tokens": 100000,  # includes the reasoning tokens
+        "thinking": False,  # reasons on its own, no thinking budget
+        "cache_write": 1.10*10**-6,
+        "cache_read": 0.55*10**-6
     }
 }
 
+# message batches are billed at half price
+BATCH_PRICE_FACTOR = 0.5
+
+# token and cost fields of the usage dict returned by the query functions
+USAGE_FIELDS = [
+    "input_tokens", "output_tokens", "cache_write_tokens", "cache_read_tokens",
+    "input_cost", "output_cost", "cache_write_cost", "cache_read_cost", "total_cost"
+]
+
+def empty_llmdat(response=""):
+    """Usage dict with zero tokens and costs"""
+    llmdat = {field: 0.0 if field.endswith("_cost") else 0 for field in USAGE_FIELDS}
+    llmdat["response"] = response
+    return llmdat
+
+def add_llmdat(total, part):
+    """Adds the tokens and costs of part to total (in place)"""
+    for field in USAGE_FIELDS:
+        total[field] += part.get(field, 0)
+    return total
+
+def usage_to_llmdat(response, model_name, input_tokens, output_tokens, cache_write_tokens=0, cache_read_tokens=0, price_factor=1.0):
+    """
+    Builds the usage dict for a response, pricing each kind of token at its own rate
+    Args:
+        response (str): Response text
+        model_name (str): Key in MODEL_CONFIG
+        input_tokens (int): Uncached input tokens
+        output_tokens (int): Output tokens
+        cache_write_tokens (int): Input tokens written to the prompt cache
+        cache_read_tokens (int): Input tokens read from the prompt cache
+        price_factor (float): Multiplier on all prices (e.g. BATCH_PRICE_FACTOR)
+    Returns:
+        dict: Response, tokens and costs
+    """
+    config = MODEL_CONFIG[model_name]
+    llmdat = {
+        "response": response,
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        "cache_write_tokens": cache_write_tokens,
+        "cache_read_tokens": cache_read_tokens,
+        "input_cost": input_tokens * config["input"] * price_factor,
+        "output_cost": output_tokens * config["output"] * price_factor,
+        "cache_write_cost": cache_write_tokens * config["cache_write"] * price_factor,
+        "cache_read_cost": cache_read_tokens * config["cache_read"] * price_factor
+    }
+    llmdat["total_cost"] = llmdat["input_cost"] + llmdat["output_cost"] + llmdat["cache_write_cost"] + llmdat["cache_read_cost"]
+    return llmdat
+
+# response cache settings
+# modes: "off", "readthrough" (use cached responses, query and save on a miss),
+# "record" (always query, save the response), "replay" (only cached responses, fail on a miss)
+# note: readthrough and replay return the same paper on every run, so keep the cache off for make-many-papers.py
+CACHE_CONFIG = {
+    "mode": os.environ.get("LLM_CACHE_MODE", "off"),
+    "folder": os.environ.get("LLM_CACHE_DIR", "./llm-cache/"),
+    "max_mb": 500,
+    "max_age_days": 30,
+    # eviction scans the whole cache folder, so it runs on the first store of a process and
+    # then at most once per interval, not after every store
+    "evict_interval_seconds": 600
+}
+
+_last_eviction = {"time": None}
+_eviction_lock = threading.Lock()
+
+CACHE_MODES = ["off", "readthrough", "record", "replay"]
+
+def configure_cache(mode=None, folder=None, max_mb=None, max_age_days=None):
+    """
+    Updates the response cache settings in CACHE_CONFIG
+    Args:
+        mode (str): One of CACHE_MODES
+        folder (str): Folder for the cache files
+        max_mb (float): Maximum size of the cache folder in MB
+        max_age_days (float): Cached responses older than this are removed
+    """
+    if mode is not None:
+        if mode not in CACHE_MODES:
+            raise ValueError(f"Unknown cache mode {mode}, use one of {CACHE_MODES}")
+        CACHE_CONFIG["mode"] = mode
+    if folder is not None:
+        CACHE_CONFIG["folder"] = folder
+    if max_mb is not None:
+        CACHE_CONFIG["max_mb"] = max_mb
+    if max_age_days is not None:
+        CACHE_CONFIG["max_age_days"] = max_age_days
+
+def cache_key(provider, model_full_name, system_prompt, full_prompt, temperature, thinking_budget, max_tokens):
+    """
+    Hashes every input that determines an LLM response into a cache key
+    """
+    key_data = {
+        "provider": provider,
+        "model": model_full_name,
+        "system_prompt": system_prompt,
+        "full_prompt": full_prompt,
+        "temperature": temperature,
+        "thinking_budget": thinking_budget,
+        "max_tokens": max_tokens
+    }
+    key_json = json.dumps(key_data, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(key_json.encode("utf-8")).hexdigest()
+
+def cache_path(key):
+    return os.path.join(CACHE_CONFIG["folder"], key[:2], f"{key}.json")
+
+def cache_lookup(key):
+    """
+    Looks up a cached response according to the cache mode
+    Args:
+        key (str): Key from cache_key
+    Returns:
+        dict: The cached response with zero costs (nothing was paid), or None if the query should be sent
+    """
+    if CACHE_CONFIG["mode"] in ["off", "record"]:
+        return None
+
+    path = cache_path(key)
+    if not os.path.exists(path):
+        if CACHE_CONFIG["mode"] == "replay":
+            raise RuntimeError(f"Cache miss in replay mode for key {key}")
+        return None
+
+    with open(path, "r", encoding="utf-8") as f:
+        llmdat = json.load(f)
+
+    # mark as recently used for eviction
+    os.utime(path)
+
+    logging.info(f"Cache hit for key {key[:12]}")
+    for field in USAGE_FIELDS:
+        if field.endswith("_cost"):
+            llmdat[field] = 0.0
+    llmdat["cache_hit"] = True
+    return llmdat
+
+def cache_store(key, llmdat):
+    """
+    Saves a response to the cache (if the cache mode saves responses) and, from time to time, evicts old entries
+    """
+    if CACHE_CONFIG["mode"] not in ["readthrough", "record"]:
+        return
+
+    path = cache_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # write to a temp file first so parallel runs never read a partial entry
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(llmdat, f, ensure_ascii=False)
+    os.replace(temp_path, path)
+
+    with _eviction_lock:
+        due = _last_eviction["time"] is None or time.time() - _last_eviction["time"] >= CACHE_CONFIG["evict_interval_seconds"]
+        if due:
+            _last_eviction["time"] = time.time()
+    if due:
+        evict_cache()
+
+def evict_cache():
+    """
+    Removes cached responses older than max_age_days, then the least recently used
+    responses until the cache folder is below max_mb
+    """
+    entries = []
+    for path in glob.glob(os.path.join(CACHE_CONFIG["folder"], "*", "*.json")):
+        stat = os.stat(path)
+        entries.append((stat.st_mtime, stat.st_size, path))
+
+    # oldest first
+    entries.sort()
+    cutoff = time.time() - CACHE_CONFIG["max_age_days"]*24*3600
+    total_bytes = sum(size for _, size, _ in entries)
+    for mtime, size, path in entries:
+        if mtime >= cutoff and total_bytes <= CACHE_CONFIG["max_mb"]*10**6:
+            break
+        if os.path.exists(path):
+            os.remove(path)
+        total_bytes -= size
+
+# Append-only SQLite ledger with one row per LLM call, shared by every run
+LEDGER_CONFIG = {
+    "path": os.environ.get("LLM_LEDGER_FILE", "./ledger.sqlite")
+}
+
+LEDGER_COLUMNS = [
+    "started", "ended", "latency_seconds", "plan", "run", "prompt", "operation", "provider", "model",
+    "input_tokens", "output_tokens", "cache_write_tokens", "cache_read_tokens",
+    "input_cost", "output_cost", "cache_write_cost", "cache_read_cost", "total_cost",
+    "cache_hit", "batch"
+]
+
+# what the current LLM call belongs to (set with ledger_context, copied into worker threads by submit_in_context)
+_ledger_vars = {
+    "plan": contextvars.ContextVar("ledger_plan", default=""),
+    "run": contextvars.ContextVar("ledger_run", default=""),
+    "prompt": contextvars.ContextVar("ledger_prompt", default=""),
+    "operation": contextvars.ContextVar("ledger_operation", default="")
+}
+
+_ledger_ready = set()
+_ledger_lock = threading.Lock()
+
+@contextmanager
+def ledger_context(**labels):
+    """
+    Labels the LLM calls made inside the with block, e.g. ledger_context(plan=plan_name, prompt="01-model")
+    Args:
+        **labels: Any of plan, run, prompt, operation
+    """
+    tokens = [(_ledger_vars[name], _ledger_vars[name].set(value)) for name, value in labels.items()]
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+def submit_in_context(executor, fn, *args):
+    """Submits fn to a thread pool with a copy of the current ledger labels"""
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+def ledger_run_name(output_folder):
+    """The run label of an output folder (the folder path with forward slashes)"""
+    return os.path.normpath(output_folder).replace("\\", "/")
+
+def _ledger_connect():
+    """Opens the ledger, creating the table and indexes the first time"""
+    path = LEDGER_CONFIG["path"]
+    connection = sqlite3.connect(path, timeout=60)
+    with _ledger_lock:
+        if path not in _ledger_ready:
+            # WAL lets parallel runs append while reports read
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS llm_calls (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    started TEXT, ended TEXT, latency_seconds REAL,
+                    plan TEXT, run TEXT, prompt TEXT, operation TEXT, provider TEXT, model TEXT,
+                    input_tokens INTEGER, output_tokens INTEGER, cache_write_tokens INTEGER, cache_read_tokens INTEGER,
+                    input_cost REAL, output_cost REAL, cache_write_cost REAL, cache_read_cost REAL, total_cost REAL,
+                    cache_hit INTEGER, batch INTEGER
+                )
+            """)
+            connection.execute("CREATE INDEX IF NOT EXISTS llm_calls_plan_run ON llm_calls (plan, run, prompt)")
+            connection.execute("CREATE INDEX IF NOT EXISTS llm_calls_model ON llm_calls (model, started)")
+            connection.commit()
+            _ledger_ready.add(path)
+    return connection
+
+def record_llm_call(model_name, llmdat, started, ended, batch=False, metrics=None, **labels):
+    """
+    Appends one LLM call to the ledger, and its metrics event to {run}/metrics.jsonl
+    Args:
+        model_name (str): Key of MODEL_CONFIG
+        llmdat (dict): Response, tokens and costs
+        started, ended (float): time.time() at the start and end of the call
+        batch (bool): The call was part of a Message Batch
+        metrics (dict): Timing details of the call (queue_wait_seconds, ttft_seconds, ...)
+        **labels: plan, run, prompt, operation (default: the current ledger_context)
+    """
+    row = {name: labels.get(name, var.get()) for name, var in _ledger_vars.items()}
+    row.update({field: llmdat.get(field, 0) for field in USAGE_FIELDS})
+    row.update({
+        "started": datetime.fromtimestamp(started, timezone.utc).isoformat(),
+        "ended": datetime.fromtimestamp(ended, timezone.utc).isoformat(),
+        "latency_seconds": ended - started,
+        "provider": MODEL_CONFIG[model_name]["type"],
+        "model": model_name,
+        "cache_hit": int(llmdat.get("cache_hit", False)),
+        "batch": int(batch)
+    })
+
+    connection = _ledger_connect()
+    with connection:
+        connection.execute(
+            f"INSERT INTO llm_calls ({', '.join(LEDGER_COLUMNS)}) VALUES ({', '.join('?' for _ in LEDGER_COLUMNS)})",
+            [row[column] for column in LEDGER_COLUMNS]
+        )
+    connection.close()
+
+    if row["run"]:
+        write_metrics_event(row, metrics or {})
+
+_metrics_lock = threading.Lock()
+
+METRICS_FIELDS = [
+    "queue_wait_seconds", "ttft_seconds", "thinking_seconds", "stream_seconds", "total_seconds",
+    "tokens_per_second", "stop_reason", "retries"
+]
+
+def write_metrics_event(row, metrics):
+    """Appends a metrics event for a ledger row to metrics.jsonl in the run's output folder"""
+    event = {name: row[name] for name in ["ended", "plan", "run", "prompt", "operation", "provider", "model", "cache_hit", "batch"]}
+    event.update({name: row[name] for name in ["input_tokens", "output_tokens", "cache_read_tokens", "total_cost"]})
+    event.update({name: metrics.get(name) for name in METRICS_FIELDS})
+    event["total_seconds"] = row["latency_seconds"]
+    if event["tokens_per_second"] is None and not row["cache_hit"]:
+        # without a stream, throughput is over the whole call
+        event["tokens_per_second"] = row["output_tokens"] / max(row["latency_seconds"], 1e-6)
+
+    with _metrics_lock:
+        with open(os.path.join(row["run"], "metrics.jsonl"), "a", encoding="utf-8") as f:
+            f.write(json.dumps(event) + "\n")
+
+def metrics_summary(output_folder):
+    """
+    Summarizes the metrics events of an output folder by prompt, operation and model
+    Returns:
+        pd.DataFrame: Calls, retries, summed queue wait / thinking / stream / total seconds,
+            mean time to first token and output tokens per second (empty if there are no events)
+    """
+    metrics_file = os.path.join(output_folder, "metrics.jsonl")
+    if not os.path.exists(metrics_file):
+        return pd.DataFrame()
+    metrics_df = pd.read_json(metrics_file, lines=True)
+    for name in METRICS_FIELDS:
+        if name not in metrics_df:
+            metrics_df[name] = None
+    numeric_fields = [name for name in METRICS_FIELDS if name != "stop_reason"]
+    metrics_df[numeric_fields] = metrics_df[numeric_fields].apply(pd.to_numeric)
+    summary_df = metrics_df.groupby(["prompt", "operation", "model"], as_index=False, sort=False).agg(
+        calls=("model", "count"),
+        retries=("retries", "sum"),
+        queue_wait=("queue_wait_seconds", "sum"),
+        ttft_mean=("ttft_seconds", "mean"),
+        thinking=("thinking_seconds", "sum"),
+        stream=("stream_seconds", "sum"),
+        total=("total_seconds", "sum"),
+        output_tokens=("output_tokens", "sum"),
+        tokens_per_second=("tokens_per_second", "mean")
+    )
+    return summary_df.round(2)
+
+def ledger_dataframe(**filters):
+    """
+    Reads ledger rows into a DataFrame
+    Args:
+        **filters: Column values to match, e.g. plan="plan0408-piecewise", run="output0408-piecewise"
+    Returns:
+        pd.DataFrame: One row per LLM call, oldest first
+    """
+    where = " AND ".join(f"{column} = ?" for column in filters) or "1"
+    connection = _ledger_connect()
+    costs_df = pd.read_sql_query(f"SELECT * FROM llm_calls WHERE {where} ORDER BY id", connection, params=list(filters.values()))
+    connection.close()
+    return costs_df
+
+def ledger_summary(by=("plan", "model"), **filters):
+    """
+    Sums calls, tokens, costs and latency in the ledger by the given columns
+    Args:
+        by (tuple): Columns to group by
+        **filters: Column values to match
+    Returns:
+        pd.DataFrame: One row per group, with output tokens per second of latency
+    """
+    where = " AND ".join(f"{column} = ?" for column in filters) or "1"
+    group = ", ".join(by)
+    connection = _ledger_connect()
+    summary_df = pd.read_sql_query(f"""
+        SELECT {group}, COUNT(*) AS calls, SUM(cache_hit) AS cache_hits,
+            SUM(input_tokens) AS input_tokens, SUM(output_tokens) AS output_tokens,
+            SUM(cache_write_tokens) AS cache_write_tokens, SUM(cache_read_tokens) AS cache_read_tokens,
+            SUM(total_cost) AS total_cost, SUM(latency_seconds) AS latency_seconds,
+            SUM(output_tokens) / NULLIF(SUM(CASE WHEN cache_hit = 0 THEN latency_seconds END), 0) AS output_tokens_per_second
+        FROM llm_calls WHERE {where} GROUP BY {group} ORDER BY {group}
+    """, connection, params=list(filters.values()))
+    connection.close()
+    return summary_df
+
+# rate limiter settings
+# the limits are learned from the rate limit headers of real responses and shared
+# across threads (lock) and processes (state file), so parallel runs pace each other
+RATE_LIMIT_CONFIG = {
+    "state_file": os.environ.get("LLM_RATELIMIT_FILE", "./temp/ratelimit-state.json")
+}
+
+# response headers for each rate limit bucket: (limit header, remaining header)
+RATE_LIMIT_HEADERS = {
+    "anthropic": {
+        "requests": ("anthropic-ratelimit-requests-limit", "anthropic-ratelimit-requests-remaining"),
+        "input_tokens": ("anthropic-ratelimit-input-tokens-limit", "anthropic-ratelimit-input-tokens-remaining"),
+        "output_tokens": ("anthropic-ratelimit-output-tokens-limit", "anthropic-ratelimit-output-tokens-remaining")
+    },
+    "openai": {
+        "requests": ("x-ratelimit-limit-requests", "x-ratelimit-remaining-requests"),
+        "tokens": ("x-ratelimit-limit-tokens", "x-ratelimit-remaining-tokens")
+    }
+}
+
+_ratelimit_lock = threading.Lock()
+
+# HTTP connection pool settings for the shared provider clients
+CLIENT_CONFIG = {
+    "max_connections": 32,
+    "max_keepalive_connections": 16,
+    "keepalive_expiry": 120,
+    "connect_timeout": 10,
+    "read_timeout": 600
+}
+
+# Retries of transient errors (dropped connections, 429, 529 overloaded, 5xx): jittered exponential backoff
+RETRY_CONFIG = {
+    "max_retries": 5,
+    "base_seconds": 2.0,
+    "max_seconds": 120.0
+}
+
+_clients = {}
+_async_clients = {}
+_clients_lock = threading.Lock()
+
+# all async model calls run on one event loop in a background thread, so sync code (and Jupyter,
+# which has its own running loop) can wait on them, and many calls share one loop
+_async_loop = None
+_async_loop_thread = None
+_async_loop_lock = threading.Lock()
+
+def _background_loop():
+    """Returns the background event loop, starting its thread on first use"""
+    global _async_loop, _async_loop_thread
+    with _async_loop_lock:
+        if _async_loop is None:
+            _async_loop = asyncio.new_event_loop()
+            _async_loop_thread = threading.Thread(target=_async_loop.run_forever, name="llm-event-loop", daemon=True)
+            _async_loop_thread.start()
+        return _async_loop
+
+def run_async(coro):
+    """
+    Runs a coroutine on the background event loop and waits for its result.
+    The caller's ledger labels (contextvars) carry over to the coroutine.
+    Args:
+        coro: Coroutine, e.g. async_query(...) or asyncio.gather(...) of many queries
+    Returns:
+        The return value of the coroutine
+    """
+    loop = _background_loop()
+    if threading.current_thread() is _async_loop_thread:
+        coro.close()
+        raise RuntimeError("run_async cannot wait from inside the event loop, await the coroutine instead")
+    return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+def configure_clients(**settings):
+    """
+    Updates CLIENT_CONFIG and closes the existing clients so the next get_client call uses the new settings
+    Args:
+        **settings: Any of the CLIENT_CONFIG keys
+    """
+    for name, value in settings.items():
+        if name not in CLIENT_CONFIG:
+            raise ValueError(f"Unknown client setting {name}")
+        CLIENT_CONFIG[name] = value
+
+    with _clients_lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
+        for client in _async_clients.values():
+            run_async(client.close())
+        _async_clients.clear()
+
+def get_client(provider):
+    """
+    Returns the long-lived client for a provider, creating it on first use.
+    Every query shares one connection pool per provider, so connections and TLS sessions are reused.
+    Args:
+        provider (str): "anthropic" or "openai"
+    Returns:
+        anthropic.Anthropic or OpenAI client
+    """
+    with _clients_lock:
+        if provider not in _clients:
+            if provider not in ("anthropic", "openai"):
+                raise ValueError(f"Unknown provider {provider}")
+
+            # build the pool settings with the SDK's own http types, which may differ from the installed httpx
+            sdk = anthropic if provider == "anthropic" else openai
+            limits = type(sdk.DEFAULT_CONNECTION_LIMITS)(
+                max_connections=CLIENT_CONFIG["max_connections"],
+                max_keepalive_connections=CLIENT_CONFIG["max_keepalive_connections"],
+                keepalive_expiry=CLIENT_CONFIG["keepalive_expiry"]
+            )
+            timeout = sdk.Timeout(CLIENT_CONFIG["read_timeout"], connect=CLIENT_CONFIG["connect_timeout"])
+
+            if provider == "anthropic":
+                _clients[provider] = anthropic.Anthropic(
+                    api_key=os.environ.get("ANTHROPIC_API_KEY"),
+                    timeout=timeout,
+                    # retries are left to RETRY_CONFIG, so they are logged, counted and keep to the step deadline
+                    max_retries=0,
+                    http_client=anthropic.DefaultHttpxClient(limits=limits)
+                )
+            else:
+                _clients[provider] = OpenAI(
+                    api_key=os.environ.get("OPENAI_API_KEY"),
+                    timeout=timeout,
+                    max_retries=0,
+                    http_client=openai.DefaultHttpxClient(limits=limits)
+                )
+
+        return _clients[provider]
+
+def get_async_client(provider):
+    """
+    Returns the long-lived async client for a provider, for use on the background event loop.
+    Uses the same pool settings as get_client.
+    Args:
+        provider (str): "anthropic" or "openai"
+    Returns:
+        anthropic.AsyncAnthropic or AsyncOpenAI client
+    """
+    with _clients_lock:
+        if provider not in _async_clients:
+            if provider not in ("anthropic", "openai"):
+                raise ValueError(f"Unknown provider {provider}")
+
+            sdk = anthropic if provider == "anthropic" else openai
+            limits = type(sdk.DEFAULT_CONNECTION_LIMITS)(
+                max_connections=CLIENT_CONFIG["max_connections"],
+                max_keepalive_connections=CLIENT_CONFIG["max_keepalive_connections"],
+                keepalive_expiry=CLIENT_CONFIG["keepalive_expiry"]
+            )
+            timeout = sdk.Timeout(CLIENT_CONFIG["read_timeout"], connect=CLIENT_CONFIG["connect_timeout"])
+
+            if provider == "anthropic":
+                _async_clients[provider] = anthropic.AsyncAnthropic(
+                    api_key=os.environ.get("ANTHROPIC_API_KEY"),
+                    timeout=timeout,
+                    # retries are left to RETRY_CONFIG, so they are logged, counted and keep to the step deadline
+                    max_retries=0,
+                    http_client=anthropic.DefaultAsyncHttpxClient(limits=limits)
+                )
+            else:
+                _async_clients[provider] = AsyncOpenAI(
+                    api_key=os.environ.get("OPENAI_API_KEY"),
+                    timeout=timeout,
+                    max_retries=0,
+                    http_client=openai.DefaultAsyncHttpxClient(limits=limits)
+                )
+
+        return _async_clients[provider]
+
+# error types in the body of an error that arrives inside a stream (after a 200 status) worth retrying
+TRANSIENT_ERROR_TYPES = ["overloaded_error", "api_error", "rate_limit_error", "timeout_error", "server_error"]
+
+def is_transient_error(e):
+    """
+    Checks whether an API error is worth retrying: dropped connections and timeouts, rate limits,
+    conflicts and server errors (also when reported inside a stream). Bad requests, auth errors,
+    unexpected responses and bugs are not.
+    """
+    if isinstance(e, (anthropic.APIStatusError, openai.APIStatusError)) and e.status_code >= 400:
+        return e.status_code in (408, 409, 429) or e.status_code >= 500
+    if isinstance(e, (anthropic.APIConnectionError, openai.APIConnectionError, OSError)):
+        return True
+    if isinstance(e, (anthropic.APIError, openai.APIError)):
+        # an error event in a stream, e.g. {"type": "error", "error": {"type": "overloaded_error", ...}}
+        body = e.body if isinstance(e.body, dict) else {}
+        error = body.get("error", body)
+        return isinstance(error, dict) and error.get("type") in TRANSIENT_ERROR_TYPES
+    # errors from the http transport while a stream is read are not wrapped by the SDKs
+    return type(e).__module__.split(".")[0].startswith("httpx")
+
+def retry_delay(attempt, e=None):
+    """
+    Seconds to wait before the next try: exponential backoff with jitter, and at least the
+    retry-after the server asked for
+    Args:
+        attempt (int): Number of tries that failed so far, minus one
+        e (Exception): The error of the last try
+    """
+    delay = min(RETRY_CONFIG["max_seconds"], RETRY_CONFIG["base_seconds"] * 2**attempt) * random.uniform(0.5, 1.0)
+    response = getattr(e, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    if retry_after is not None and re.fullmatch(r"\d+(\.\d+)?", retry_after):
+        delay = max(delay, float(retry_after))
+    return delay
+
+async def should_retry(e, attempt, deadline=None):
+    """
+    Decides whether to retry after an error, and sleeps for the backoff if so (without blocking the event loop)
+    Args:
+        e (Exception): The error
+        attempt (int): Number of tries that failed so far, minus one
+        deadline (float): time.time() after which no new try starts (None for no deadline)
+    Returns:
+        bool: True if the caller should try again
+    """
+    if not is_transient_error(e) or attempt >= RETRY_CONFIG["max_retries"]:
+        return False
+    delay = retry_delay(attempt, e)
+    if deadline is not None and time.time() + delay > deadline:
+        return False
+    logging.warning(f"Transient error ({type(e).__name__}), retrying in {delay:.1f} seconds (retry {attempt + 1} of {RETRY_CONFIG['max_retries']})")
+    await asyncio.sleep(delay)
+    return True
+
+def estimate_tokens(text):
+    """Rough token count (about 4 characters per token) for rate limit pacing."""
+    return len(text) // 4 + 1
+
+def _locked_ratelimit_state(update_fn):
+    """
+    Reads the rate limit state file, applies update_fn to it and writes it back,
+    holding a thread lock and an OS file lock so other processes wait their turn
+    Returns:
+        The return value of update_fn
+    """
+    state_file = RATE_LIMIT_CONFIG["state_file"]
+    os.makedirs(os.path.dirname(os.path.abspath(state_file)), exist_ok=True)
+
+    with _ratelimit_lock, open(f"{state_file}.lock", "a+") as lock:
+        # the OS releases the file lock if a process dies while holding it
+        if os.name == "nt":
+            lock.seek(0)
+            msvcrt.locking(lock.fileno(), msvcrt.LK_LOCK, 1)
+        else:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+
+        if os.path.exists(state_file):
+            with open(state_file, "r", encoding="utf-8") as f:
+                state = json.load(f)
+        else:
+            state = {}
+
+        result = update_fn(state)
+
+        with open(state_file, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+
+        if os.name == "nt":
+            lock.seek(0)
+            msvcrt.locking(lock.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+    return result
+
+def _refill_buckets(model_state, now):
+    # token bucket refill: each limit is per minute
+    elapsed = now - model_state["updated"]
+    for bucket, limit in model_state["limits"].items():
+        model_state["available"][bucket] = min(limit, model_state["available"][bucket] + limit * elapsed / 60)
+    model_state["updated"] = now
+
+def ratelimit_reserve(provider, model_full_name, needed):
+    """
+    Reserves rate limit budget for a request and returns how long to wait before sending it.
+    Reservations are debited right away, so concurrent callers queue up behind each other.
+    Args:
+        provider (str): "anthropic" or "openai"
+        model_full_name (str): Full model name (limits are per model)
+        needed (dict): Budget the request needs for each bucket, e.g. {"requests": 1, "input_tokens": 5000}
+    Returns:
+        float: Seconds to sleep before sending the request (0 if the budget is there)
+    """
+    def reserve(state):
+        model_state = state.get(f"{provider}/{model_full_name}")
+        if model_state is None:
+            # nothing learned yet, the first response will tell us the limits
+            return 0.0
+
+        now = time.time()
+        _refill_buckets(model_state, now)
+
+        wait_seconds = 0.0
+        for bucket, limit in model_state["limits"].items():
+            amount = min(needed.get(bucket, 0), limit)
+            shortfall = amount - model_state["available"][bucket]
+            if shortfall > 0:
+                wait_seconds = max(wait_seconds, shortfall / (limit / 60))
+            model_state["available"][bucket] -= amount
+
+        return wait_seconds
+
+    return _locked_ratelimit_state(reserve)
+
+def ratelimit_update(provider, model_full_name, headers):
+    """
+    Learns the limits and remaining budget of a model from the headers of a real response.
+    Args:
+        provider (str): "anthropic" or "openai"
+        model_full_name (str): Full model name
+        headers: Response headers (dict-like)
+    """
+    learned = {}
+    for bucket, (limit_header, remaining_header) in RATE_LIMIT_HEADERS[provider].items():
+        if headers.get(limit_header) is not None and headers.get(remaining_header) is not None:
+            learned[bucket] = (int(headers.get(limit_header)), int(headers.get(remaining_header)))
+    if not learned:
+        return
+
+    def update(state):
+        now = time.time()
+        model_state = state.setdefault(f"{provider}/{model_full_name}", {"limits": {}, "available": {}, "updated": now})
+        _refill_buckets(model_state, now)
+        for bucket, (limit, remaining) in learned.items():
+            model_state["limits"][bucket] = limit
+            model_state["available"][bucket] = remaining
+
+    _locked_ratelimit_state(update)
+
+async def ratelimit_wait(provider, model_full_name, needed):
+    """
+    Sleeps until the projected rate limit budget covers the request (without blocking the event loop)
+    Returns:
+        float: Seconds slept
+    """
+    # the state file lock can wait on other processes, so it is taken off the event loop
+    wait_seconds = await asyncio.to_thread(ratelimit_reserve, provider, model_full_name, needed)
+    if wait_seconds > 0:
+        logging.warning(f"Rate limit budget low for {model_full_name}. Pausing for {wait_seconds:.1f} seconds...")
+        await asyncio.sleep(wait_seconds)
+    return wait_seconds
+
+# decoded context files as rendered <context> blocks, reused by every prompt until the file changes
+_context_store = {}
+_context_store_lock = threading.Lock()
+
+def context_block(file):
+    """
+    Returns the <context> block of a file, read from disk only if its mtime or size changed
+    since the last call (so an n-step plan reads each earlier response once, not n times)
+    Args:
+        file (str): Path of the context file
+    Returns:
+        str: <context name="{file}">...</context>
+    """
+    # stat before reading: if the file changes in between, the next call reads it again
+    stat = os.stat(file)
+    signature = (stat.st_mtime_ns, stat.st_size)
+    with _context_store_lock:
+        cached = _context_store.get(file)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+
+    with open(file, 'r', encoding='utf-8') as f:
+        content = f.read()
+    block = f"<context name=\"{file}\">\n{content}\n</context>"
+    with _context_store_lock:
+        _context_store[file] = (signature, block)
+    return block
 
 def assemble_prompt(instructions, context_files=None):
     """
@@ -86,116 +862,622 @@ def assemble_prompt(instructions, context_files=None):
     Returns:
         str: Assembled prompt
     """
-    prompt_parts = []
+    return prompt_text(assemble_prompt_blocks(instructions, context_files))
+
+def assemble_prompt_blocks(instructions, context_files=None, cache_after=None):
+    """
+    Assembles a prompt as a list of Anthropic text blocks, one per context file, with a prompt
+    cache breakpoint after each file in cache_after. Put the context that is shared with other
+    prompts first (e.g. earlier responses, in plan order). The cache is looked up at block
+    boundaries, so a prompt that adds one more response still hits the prefix cached by the last one.
+    Args:
+        instructions (str): The main instructions/query
+        context_files (list): Optional list of context file paths
+        cache_after (list): Optional list of context file paths to put a cache breakpoint after
+    Returns:
+        list: Text blocks; prompt_text(blocks) gives the same string as assemble_prompt
+    """
+    cache_after = cache_after or []
+    blocks = []
     
-    # Add context if provided
-    if context_files:
-        for file in context_files:
-            with open(file, 'r', encoding='utf-8') as f:
-                content = f.read()
-                prompt_parts.append(f"<context name=\"{file}\">\n{content}\n</context>")
+    # Add context if provided, each file in its own block
+    for file in context_files or []:
+        block = {"type": "text", "text": context_block(file)}
+
+        # mark the prefix up to here for caching
+        if file in cache_after:
+            block["cache_control"] = {"type": "ephemeral"}
+        blocks.append(block)
     
     # Add instructions
-    prompt_parts.append(f"<instructions>\n{instructions}\n</instructions>")
+    blocks.append({"type": "text", "text": f"<instructions>\n{instructions}\n</instructions>"})
     
-    return "\n\n".join(prompt_parts)
+    return blocks
 
-def query_claude(model_name, full_prompt, system_prompt, max_tokens, thinking_budget, temperature):
-    client = anthropic.Anthropic(api_key=os.environ.get("ANTHROPIC_API_KEY"))
+def prompt_text(full_prompt):
+    """Returns the prompt as a string, joining text blocks if needed"""
+    if isinstance(full_prompt, str):
+        return full_prompt
+    return "\n\n".join(block["text"] for block in full_prompt)
 
-    # set the model config
-    config = MODEL_CONFIG[model_name]
-    model_full_name = config["full_name"]
-    max_tokens = min(max_tokens, config["max_output_tokens"])
+def build_prompt_dag(prompts):
+    """
+    Builds the dependency graph of a plan from the optional `depends_on` key of each prompt.
+    Prompts without `depends_on` depend on all previous prompts (the original sequential behavior).
 
-    # Log the request details
-    logging.info(f"Querying model: {model_full_name}")
-    logging.info(f"Max tokens: {max_tokens}, Temperature: {temperature}")
-    logging.info(f"Full prompt: {full_prompt[:200]}...")  # Log the first 200 characters of the prompt
+    Args:
+        prompts (list): List of prompt dicts from the plan yaml
+    Returns:
+        dict: Maps each prompt name to the list of prompt names it depends on directly
+    """
+    names = [prompt["name"] for prompt in prompts]
+    if len(set(names)) != len(names):
+        raise ValueError("Prompt names in the plan must be unique")
+
+    deps = {}
+    for index, prompt in enumerate(prompts):
+        if "depends_on" in prompt:
+            # allow a single name, a list of names, or None for no dependencies
+            depends_on = prompt["depends_on"] or []
+            if isinstance(depends_on, str):
+                depends_on = [depends_on]
+            for dep in depends_on:
+                if dep not in names:
+                    raise ValueError(f"Prompt {prompt['name']} depends on unknown prompt {dep}")
+            deps[prompt["name"]] = list(depends_on)
+        else:
+            deps[prompt["name"]] = names[:index]
+
+    # check for cycles with a depth first search
+    state = {}
+    def visit(name, path):
+        if state.get(name) == "done":
+            return
+        if state.get(name) == "visiting":
+            raise ValueError(f"Cycle in prompt dependencies: {' -> '.join(path + [name])}")
+        state[name] = "visiting"
+        for dep in deps[name]:
+            visit(dep, path + [name])
+        state[name] = "done"
+
+    for name in names:
+        visit(name, [])
+
+    return deps
+
+def prompt_ancestors(prompts, deps):
+    """
+    Finds all direct and indirect dependencies of each prompt, in plan order.
+    These are the prompts whose responses are guaranteed to exist when the prompt runs.
 
-    try:
-        # check tokens remaining
-        count_response = client.messages.with_raw_response.create(
-            model="claude-3-7-sonnet-20250219",
-            max_tokens=1,
-            messages=[{"role": "user", "content": "."}]
-        )
+    Args:
+        prompts (list): List of prompt dicts from the plan yaml
+        deps (dict): Dependency graph from build_prompt_dag
+    Returns:
+        dict: Maps each prompt name to the list of its ancestor names, in plan order
+    """
+    names = [prompt["name"] for prompt in prompts]
+    ancestors = {}
 
-        # Get remaining tokens and reset time
-        tokens_remaining = int(count_response.headers.get('anthropic-ratelimit-tokens-remaining', 0))
-        reset_time_str = count_response.headers.get('anthropic-ratelimit-tokens-reset', '60')
+    def collect(name):
+        if name not in ancestors:
+            found = set()
+            for dep in deps[name]:
+                found.add(dep)
+                found.update(collect(dep))
+            ancestors[name] = found
+        return ancestors[name]
 
-        # Handle the reset_time more carefully
-        reset_time_dt = datetime.fromisoformat(reset_time_str.replace('Z', '+00:00'))
-        current_time = datetime.now(timezone.utc)
-        reset_seconds = int((reset_time_dt - current_time).total_seconds())
+    return {name: [other for other in names if other in collect(name)] for name in names}
 
-        if tokens_remaining < 5000:
-            logging.warning(f"Rate limit low ({tokens_remaining} tokens). Pausing for {reset_seconds} seconds...")
-            time.sleep(reset_seconds + 5)  # Add 5 seconds buffer        
+def select_context(prompts, ancestors):
+    """
+    Picks the earlier responses each prompt gets as context, from the optional `context` key:
+    a list of prompt names or glob patterns (e.g. "*-prose"), or "none".
+    Prompts without `context` get the responses of all their ancestors (the original behavior).
+    Only ancestors can be context, since only their responses are sure to exist when the prompt runs.
 
-        # set llm input parameters
-        params = {
-            "model": model_full_name,
-            "max_tokens": max_tokens,
-            "temperature": temperature,
-            "messages": [
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text", 
-                            "text": full_prompt
-                        }
-                    ]
-                }
-            ]
+    Args:
+        prompts (list): List of prompt dicts from the plan yaml
+        ancestors (dict): Ancestors of each prompt from prompt_ancestors
+    Returns:
+        dict: Maps each prompt name to the list of prompt names whose responses are context, in plan order
+    """
+    names = [prompt["name"] for prompt in prompts]
+    context = {}
+    for prompt in prompts:
+        name = prompt["name"]
+        if "context" not in prompt:
+            context[name] = ancestors[name]
+            continue
+
+        # allow a single pattern, a list of patterns, or "none" / None for no earlier responses
+        patterns = prompt["context"] or []
+        if isinstance(patterns, str):
+            patterns = [] if patterns.lower() == "none" else [patterns]
+
+        selected = set()
+        for pattern in patterns:
+            matches = [other for other in ancestors[name] if fnmatch.fnmatchcase(other, pattern)]
+            if not matches:
+                if pattern in names:
+                    raise ValueError(f"Prompt {name} uses {pattern} as context but does not depend on it (add it to depends_on)")
+                raise ValueError(f"Context {pattern} of prompt {name} matches no earlier prompt")
+            selected.update(matches)
+        context[name] = [other for other in ancestors[name] if other in selected]
+
+    return context
+
+def critical_path_priority(prompts, deps, weights):
+    """
+    Computes the scheduling priority of each prompt as the weight of the longest chain
+    that starts at the prompt, so that long chains of slow steps are started first.
+
+    Args:
+        prompts (list): List of prompt dicts from the plan yaml
+        deps (dict): Dependency graph from build_prompt_dag
+        weights (dict): Maps each prompt name to its estimated cost (e.g. max tokens)
+    Returns:
+        dict: Maps each prompt name to its priority (higher runs first)
+    """
+    dependents = {prompt["name"]: [] for prompt in prompts}
+    for name, names_needed in deps.items():
+        for dep in names_needed:
+            dependents[dep].append(name)
+
+    priority = {}
+    def chain(name):
+        if name not in priority:
+            priority[name] = weights[name] + max([chain(child) for child in dependents[name]], default=0)
+        return priority[name]
+
+    for prompt in prompts:
+        chain(prompt["name"])
+
+    return priority
+
+def run_prompt_dag(prompts, run_fn, indices, deps, priority, max_concurrency=1):
+    """
+    Runs the selected prompts with a thread pool, starting each prompt as soon as the
+    prompts it depends on have finished. Prompts outside `indices` are treated as done.
+
+    Args:
+        prompts (list): List of prompt dicts from the plan yaml
+        run_fn (callable): Function that takes a prompt index and runs the prompt
+        indices (list): Indices of the prompts to run
+        deps (dict): Dependency graph from build_prompt_dag
+        priority (dict): Priorities from critical_path_priority
+        max_concurrency (int): Maximum number of prompts running at once
+    """
+    names = [prompt["name"] for prompt in prompts]
+    pending = {names[index]: index for index in indices}
+    running = {}
+    errors = []
+
+    with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+        while pending or running:
+            # start every ready prompt, highest priority first
+            if not errors:
+                ready = [name for name in pending if not any(dep in pending or dep in running.values() for dep in deps[name])]
+                ready.sort(key=lambda name: (-priority[name], pending[name]))
+                for name in ready[:max(0, max_concurrency - len(running))]:
+                    logging.info(f"Starting prompt {name}")
+                    running[submit_in_context(executor, run_fn, pending.pop(name))] = name
+
+            if not running:
+                break
+
+            # wait for any prompt to finish
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                if future.exception() is not None:
+                    logging.error(f"Prompt {name} failed: {future.exception()}")
+                    errors.append(future.exception())
+                else:
+                    logging.info(f"Finished prompt {name}")
+
+    # stop the run on the first failure, like the sequential loop did
+    if errors:
+        raise errors[0]
+
+_manifest_lock = threading.Lock()
+
+def step_input_hash(full_prompt, system_prompt, settings):
+    """
+    Hashes everything that determines a step's output: the full prompt (instructions and the
+    contents of every context file), the system prompt and the model settings.
+    Since earlier responses are part of the prompt, a changed step invalidates every step downstream.
+    Args:
+        full_prompt (str): Assembled prompt
+        system_prompt (str): System prompt sent with the prompt
+        settings (dict): Model name, max tokens, thinking budget, temperature, etc.
+    Returns:
+        str: sha256 hex digest
+    """
+    hash_data = {
+        "full_prompt": full_prompt,
+        "system_prompt": system_prompt,
+        "settings": settings
+    }
+    hash_json = json.dumps(hash_data, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(hash_json.encode("utf-8")).hexdigest()
+
+def load_manifest(output_folder):
+    """
+    Loads the manifest of completed steps from the output folder
+    Returns:
+        dict: Maps step names to {"input_hash", "completed", "ledger"}, empty if there is no manifest
+    """
+    manifest_file = f"{output_folder}manifest.json"
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def update_manifest(output_folder, step_name, input_hash, ledger=None):
+    """
+    Records a completed step in the manifest (safe to call from concurrent steps)
+    Args:
+        ledger (dict): Where the step's LLM calls are in the ledger: run, started and ended
+            (UTC isoformat), for the cost report of the folder (aggregate_costs)
+    """
+    with _manifest_lock:
+        manifest = load_manifest(output_folder)
+        manifest[step_name] = {
+            "input_hash": input_hash,
+            "completed": datetime.now(timezone.utc).isoformat()
         }
+        if ledger is not None:
+            manifest[step_name]["ledger"] = ledger
+        temp_file = f"{output_folder}manifest.json.tmp"
+        with open(temp_file, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(temp_file, f"{output_folder}manifest.json")
+
+def step_is_current(output_folder, step_name, input_hash):
+    """
+    Checks whether a step already ran with exactly these inputs and its response is still on disk
+    """
+    entry = load_manifest(output_folder).get(step_name)
+    return entry is not None and entry["input_hash"] == input_hash and os.path.exists(f"{output_folder}{step_name}-response.md")
+
+def current_steps(execution_plan, indices, output_folder):
+    """
+    Names of the steps that a run would skip because they already ran with exactly these inputs
+    (step_is_current), e.g. when resuming a run. A step whose context comes from a step that
+    reruns is not current, since that response will change.
+    Args:
+        execution_plan (dict): From compile_plan
+        indices (list): Indices of the steps in the run range
+        output_folder (str): Output folder of the run
+    Returns:
+        list: Step names, in plan order
+    """
+    config, prompts = execution_plan["config"], execution_plan["prompts"]
+    names_run = {prompts[index]["name"] for index in indices}
+    current = []
+    for index in sorted(indices):
+        name = prompts[index]["name"]
+        context_names = execution_plan["context"][name]
+        if any(dep in names_run and dep not in current for dep in context_names):
+            continue
+        if not all(os.path.exists(f"{output_folder}{dep}-response.md") for dep in context_names):
+            continue
+        step = prepare_step(prompts, index, config, output_folder, context_names, echo=False)
+        if step_is_current(output_folder, name, step["input_hash"]):
+            current.append(name)
+    return current
+
+def fork_prefix(execution_plan, fork_after):
+    """
+    Names of the steps that forked runs share: the first fork_after steps of the run range
+    Args:
+        execution_plan (dict): From compile_plan
+        fork_after (int): Number of shared steps
+    Returns:
+        list: Step names, in plan order
+    Raises:
+        ValueError: If a shared step depends on a step after the fork
+    """
+    indices = execution_plan["indices"]
+    if not 1 <= fork_after < len(indices):
+        raise ValueError(f"fork_after must be between 1 and {len(indices) - 1} (the plan runs {len(indices)} steps)")
+    prefix_names = [execution_plan["prompts"][index]["name"] for index in indices[:fork_after]]
+    for name in prefix_names:
+        for dep in execution_plan["deps"][name]:
+            if dep not in prefix_names:
+                raise ValueError(f"Step {name} is before the fork but depends on {dep}, which is after it")
+    return prefix_names
+
+def fork_run_folder(execution_plan, prefix_folder, run_folder, prefix_names):
+    """
+    Starts a forked run from a finished prefix run: hard links the prefix responses into the
+    run folder (copies them where links are not supported) and records them in the run's manifest,
+    so make-paper.py and the batch runner skip them and only run the steps after the fork
+    Args:
+        execution_plan (dict): From compile_plan
+        prefix_folder (str): Output folder of the prefix run
+        run_folder (str): Output folder of the forked run
+        prefix_names (list): Shared steps, from fork_prefix
+    """
+    config, prompts = execution_plan["config"], execution_plan["prompts"]
+    names = [prompt["name"] for prompt in prompts]
+    for name in prefix_names:
+        source = f"{prefix_folder}{name}-response.md"
+        target = f"{run_folder}{name}-response.md"
+        if os.path.exists(target):
+            os.remove(target)
+        try:
+            os.link(source, target)
+        except OSError:
+            shutil.copy2(source, target)
+
+    # the input hashes as seen from the run folder (prompts name their context files by path),
+    # and the prefix's ledger rows, so the run's cost report includes the shared steps
+    prefix_manifest = load_manifest(prefix_folder)
+    for name in prefix_names:
+        step = prepare_step(prompts, names.index(name), config, run_folder, execution_plan["context"][name])
+        update_manifest(run_folder, name, step["input_hash"], prefix_manifest.get(name, {}).get("ledger"))
+
+def claude_params(model_name, full_prompt, system_prompt, max_tokens, thinking_budget, temperature, prefill=""):
+    """
+    Builds the messages.create parameters for a Claude query (shared by streaming and batch queries)
+    Args:
+        full_prompt (str or list): Prompt string, or text blocks from assemble_prompt_blocks
+        prefill (str): Start of the assistant response for the model to continue (needs thinking_budget=0)
+    Returns:
+        dict: Request parameters
+    """
+    # plain string prompts become a single text block
+    if isinstance(full_prompt, str):
+        content = [
+            {
+                "type": "text", 
+                "text": full_prompt
+            }
+        ]
+    else:
+        content = full_prompt
+
+    # set llm input parameters
+    params = {
+        "model": MODEL_CONFIG[model_name]["full_name"],
+        "max_tokens": max_tokens,
+        "temperature": temperature,
+        "messages": [
+            {
+                "role": "user",
+                "content": content
+            }
+        ]
+    }
 
-        # set system prompt if enabled
-        if system_prompt:
-            params["system"] = system_prompt
+    # the api rejects a prefill that ends with whitespace
+    if prefill.rstrip():
+        params["messages"].append({
+            "role": "assistant",
+            "content": prefill.rstrip()
+        })
 
-        # set thinking budget if enabled
-        if thinking_budget > 0:
-            params["thinking"] = {
-                "type": "enabled",
-                "budget_tokens": thinking_budget
+    # set system prompt if enabled (cached, it is the same for every prompt in a plan)
+    if system_prompt:
+        params["system"] = [
+            {
+                "type": "text",
+                "text": system_prompt,
+                "cache_control": {"type": "ephemeral"}
             }
-            params["temperature"] = 1.0
-
-        response = ""
-        with client.messages.stream(**params) as stream:
-            for text in stream.text_stream:
-                response += text
-                print(text, end='', flush=True)
-
-        final_response = stream.get_final_message()
-
-        # Log the response details
-        logging.info(f"Response received with {final_response.usage.output_tokens} output tokens.")
-
-        # Calculate costs
-        input_cost = final_response.usage.input_tokens * config["input"]
-        output_cost = final_response.usage.output_tokens * config["output"]
-        total_cost = input_cost + output_cost
-
-        return {
-            "response": response,
-            "input_tokens": final_response.usage.input_tokens,
-            "output_tokens": final_response.usage.output_tokens,
-            "input_cost": input_cost,
-            "output_cost": output_cost,
-            "total_cost": total_cost
+        ]
+
+    # set thinking budget if enabled
+    if thinking_budget > 0:
+        params["thinking"] = {
+            "type": "enabled",
+            "budget_tokens": thinking_budget
         }
+        params["temperature"] = 1.0
 
-    except Exception as e:
-        # Log the exception details
-        logging.error(f"An error occurred while querying Claude: {e}")
-        raise
+    return params
 
-def query_openai(model_name, full_prompt, system_prompt, max_tokens):
-    client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+def read_partial(partial_file, key):
+    """
+    Returns the text of an interrupted generation saved in partial_file, if it is for the same query
+    Args:
+        partial_file (str): Path of the partial response (None to skip)
+        key (str): cache_key of the query, saved next to the partial response
+    Returns:
+        str: Partial response ("" if there is none)
+    """
+    if partial_file is None or not os.path.exists(partial_file) or not os.path.exists(f"{partial_file}.key"):
+        return ""
+    with open(f"{partial_file}.key", "r", encoding="utf-8") as f:
+        if f.read().strip() != key:
+            return ""
+    with open(partial_file, "r", encoding="utf-8") as f:
+        return f.read()
+
+async def async_query_claude(model_name, full_prompt, system_prompt, max_tokens, thinking_budget, temperature, echo=True, partial_file=None, deadline=None):
+    """
+    Queries Claude with streaming, on the event loop.
+    Transient errors are retried with backoff (RETRY_CONFIG). If the stream fails partway, the
+    retry resumes by sending the partial text back as an assistant prefill, so only the rest of
+    the response is generated and billed. With partial_file, the text is also appended to the file
+    as it streams, and a partial file left by a crashed run is resumed the same way.
+    Args:
+        full_prompt (str or list): Prompt string, or text blocks from assemble_prompt_blocks (with cache breakpoints)
+        echo (bool): Print the response as it streams
+        partial_file (str): Where to save the response as it streams (deleted once it completes)
+        deadline (float): time.time() by which the query must finish (None for no deadline)
+    Returns:
+        dict: Response, tokens and costs
+    """
+    client = get_async_client("anthropic")
+
+    # set the model config
+    config = MODEL_CONFIG[model_name]
+    model_full_name = config["full_name"]
+    max_tokens = min(max_tokens, config["max_output_tokens"])
+
+    # Return the cached response if there is one
+    key = cache_key("anthropic", model_full_name, system_prompt, prompt_text(full_prompt), temperature, thinking_budget, max_tokens)
+    cached = await asyncio.to_thread(cache_lookup, key)
+    if cached is not None:
+        await asyncio.to_thread(record_llm_call, model_name, cached, time.time(), time.time())
+        return cached
+
+    # Log the request details
+    logging.info(f"Querying model: {model_full_name}")
+    logging.info(f"Max tokens: {max_tokens}, Temperature: {temperature}")
+    logging.info(f"Full prompt: {prompt_text(full_prompt)[:200]}...")  # Log the first 200 characters of the prompt
+
+    # pick up where an earlier, interrupted run of the same query stopped
+    response = read_partial(partial_file, key)
+    if response:
+        logging.info(f"Resuming from {len(response)} characters saved in {partial_file}")
+    elif partial_file is not None:
+        with open(f"{partial_file}.key", "w", encoding="utf-8") as f:
+            f.write(key)
+        open(partial_file, "w", encoding="utf-8").close()
+
+    llmdat = empty_llmdat()
+    time_start = time.time()
+    metrics = {"queue_wait_seconds": 0.0, "retries": 0}
+    first_token = None
+    first_text = None
+    for attempt in range(RETRY_CONFIG["max_retries"] + 1):
+        if response:
+            # continue the partial response; thinking cannot be combined with a prefill
+            response = response.rstrip()
+            attempt_max_tokens = max(1024, max_tokens - estimate_tokens(response))
+            params = claude_params(model_name, full_prompt, system_prompt, attempt_max_tokens, 0, temperature, prefill=response)
+            if partial_file is not None:
+                with open(partial_file, "w", encoding="utf-8") as f:
+                    f.write(response)
+        else:
+            params = claude_params(model_name, full_prompt, system_prompt, max_tokens, thinking_budget, temperature)
+
+        # wait for rate limit budget (learned from earlier responses, no probe request needed)
+        metrics["queue_wait_seconds"] += await ratelimit_wait("anthropic", model_full_name, {
+            "requests": 1,
+            "input_tokens": estimate_tokens(system_prompt + prompt_text(full_prompt) + response),
+            "output_tokens": params["max_tokens"]
+        })
+
+        attempt_text = ""
+        partial = open(partial_file, "a", encoding="utf-8") if partial_file is not None else None
+        request_sent = time.time()
+        # a deadline also caps how long the request may stall
+        request_options = {"timeout": max(1.0, deadline - time.time())} if deadline is not None else {}
+        try:
+            async with client.messages.stream(**params, **request_options) as stream:
+                await asyncio.to_thread(ratelimit_update, "anthropic", model_full_name, stream.response.headers)
+                async for event in stream:
+                    if deadline is not None and time.time() > deadline:
+                        raise TimeoutError(f"{model_name} query passed its deadline")
+                    if event.type != "content_block_delta":
+                        continue
+
+                    # time to the first token (thinking or text), and to the first text token
+                    if first_token is None:
+                        first_token = time.time()
+                        metrics["ttft_seconds"] = first_token - request_sent
+                    if event.delta.type != "text_delta":
+                        continue
+                    if first_text is None:
+                        first_text = time.time()
+
+                    text = event.delta.text
+                    attempt_text += text
+                    if partial is not None:
+                        partial.write(text)
+                        partial.flush()
+                    # printing is turned off when several queries stream at once
+                    if echo:
+                        print(text, end='', flush=True)
+
+            final_response = await stream.get_final_message()
+
+        except Exception as e:
+            # Log the exception details
+            logging.error(f"An error occurred while querying Claude: {e}")
+
+            # the interrupted attempt was still billed if it streamed, count it from the text that arrived
+            if attempt_text:
+                add_llmdat(llmdat, usage_to_llmdat(
+                    "", 
+                    model_name, 
+                    input_tokens=estimate_tokens(system_prompt + prompt_text(full_prompt) + response), 
+                    output_tokens=estimate_tokens(attempt_text)
+                ))
+            response += attempt_text
+            if partial is not None:
+                partial.close()
+
+            # requests that are wrong (rather than interrupted) would fail again
+            if not await should_retry(e, attempt, deadline):
+                raise
+            metrics["retries"] += 1
+            if response:
+                logging.warning(f"Resuming the response after {len(response)} characters")
+            continue
+
+        finally:
+            if partial is not None:
+                partial.close()
+
+        response += attempt_text
+        break
+
+    # Log the response details
+    usage = final_response.usage
+    logging.info(f"Response received with {usage.output_tokens} output tokens.")
+    logging.info(f"Prompt cache: {usage.cache_read_input_tokens or 0} tokens read, {usage.cache_creation_input_tokens or 0} tokens written")
+
+    # Calculate costs (input_tokens excludes the cached tokens)
+    add_llmdat(llmdat, usage_to_llmdat(
+        response, 
+        model_name, 
+        input_tokens=usage.input_tokens, 
+        output_tokens=usage.output_tokens,
+        cache_write_tokens=usage.cache_creation_input_tokens or 0,
+        cache_read_tokens=usage.cache_read_input_tokens or 0
+    ))
+    llmdat["response"] = response
+    await asyncio.to_thread(cache_store, key, llmdat)
+
+    # split the time into thinking (before the first text token) and streaming the text
+    time_end = time.time()
+    metrics["stop_reason"] = final_response.stop_reason
+    if first_token is not None:
+        metrics["thinking_seconds"] = (first_text or time_end) - first_token
+        metrics["stream_seconds"] = time_end - first_token
+        metrics["tokens_per_second"] = llmdat["output_tokens"] / max(metrics["stream_seconds"], 1e-6)
+    await asyncio.to_thread(record_llm_call, model_name, llmdat, time_start, time_end, metrics=metrics)
+
+    # the response is complete, the partial file is no longer needed
+    if partial_file is not None:
+        os.remove(partial_file)
+        os.remove(f"{partial_file}.key")
+
+    return llmdat
+
+async def async_query_openai(model_name, full_prompt, system_prompt, max_tokens, deadline=None):
+    """
+    Queries an OpenAI model on the event loop, retrying transient errors with backoff (RETRY_CONFIG)
+    Args:
+        deadline (float): time.time() by which the query must finish (None for no deadline)
+    Returns:
+        dict: Response, tokens and costs
+    """
+    client = get_async_client("openai")
+
+    # Return the cached response if there is one
+    key = cache_key("openai", MODEL_CONFIG[model_name]["full_name"], system_prompt, full_prompt, None, None, max_tokens)
+    cached = await asyncio.to_thread(cache_lookup, key)
+    if cached is not None:
+        await asyncio.to_thread(record_llm_call, model_name, cached, time.time(), time.time())
+        return cached
 
     # add system prompt before full_prompt with tags
     full_prompt2 = f"<system>\n{system_prompt}\n</system>\n\n<user>\n{full_prompt}\n</user>"
@@ -211,44 +1493,376 @@ def query_openai(model_name, full_prompt, system_prompt, max_tokens):
         ]
     }
 
-    final_response = client.chat.completions.create(**params)
+    time_start = time.time()
+    queue_wait = 0.0
+    for attempt in range(RETRY_CONFIG["max_retries"] + 1):
+        # wait for rate limit budget, then learn the limits from the response headers
+        queue_wait += await ratelimit_wait("openai", params["model"], {
+            "requests": 1,
+            "tokens": estimate_tokens(full_prompt2) + max_tokens
+        })
+        request_options = {"timeout": max(1.0, deadline - time.time())} if deadline is not None else {}
+        try:
+            raw_response = await client.chat.completions.with_raw_response.create(**params, **request_options)
+            break
+        except Exception as e:
+            logging.error(f"An error occurred while querying {model_name}: {e}")
+            if not await should_retry(e, attempt, deadline):
+                raise
+    await asyncio.to_thread(ratelimit_update, "openai", params["model"], raw_response.headers)
+    final_response = raw_response.parse()
     
-    # Calculate costs
-    config = MODEL_CONFIG[model_name]
-    input_cost = final_response.usage.prompt_tokens * config["input"]
-    output_cost = final_response.usage.completion_tokens * config["output"]
-    total_cost = input_cost + output_cost
-
-    return {
-        "response": final_response.choices[0].message.content,
-        "input_tokens": final_response.usage.prompt_tokens,
-        "output_tokens": final_response.usage.completion_tokens,
-        "input_cost": input_cost,
-        "output_cost": output_cost,
-        "total_cost": total_cost
-    }
+    # Calculate costs (openai caches long prompt prefixes automatically, prompt_tokens includes them)
+    usage = final_response.usage
+    cached_tokens = usage.prompt_tokens_details.cached_tokens if usage.prompt_tokens_details else 0
+    llmdat = usage_to_llmdat(
+        final_response.choices[0].message.content, 
+        model_name, 
+        input_tokens=usage.prompt_tokens - cached_tokens, 
+        output_tokens=usage.completion_tokens,
+        cache_read_tokens=cached_tokens
+    )
+    await asyncio.to_thread(cache_store, key, llmdat)
+    await asyncio.to_thread(record_llm_call, model_name, llmdat, time_start, time.time(), metrics={
+        "queue_wait_seconds": queue_wait,
+        "stop_reason": final_response.choices[0].finish_reason,
+        "retries": attempt
+    })
+
+    return llmdat
+
+async def async_query(model_name, full_prompt, system_prompt, max_tokens, thinking_budget=0, temperature=1.0, echo=False, partial_file=None, deadline=None):
+    """
+    Queries any model in MODEL_CONFIG on the event loop. Many queries can run at once with
+    asyncio.gather, sharing one connection pool per provider.
+    Args:
+        full_prompt (str or list): Prompt string, or text blocks from assemble_prompt_blocks
+        thinking_budget, temperature, echo, partial_file: Used by Claude models only
+        deadline (float): time.time() by which the query must finish (None for no deadline)
+    Returns:
+        dict: Response, tokens and costs
+    """
+    if MODEL_CONFIG[model_name]["type"] == "anthropic":
+        return await async_query_claude(
+            model_name, full_prompt, system_prompt, max_tokens, thinking_budget, temperature,
+            echo=echo, partial_file=partial_file, deadline=deadline
+        )
+    return await async_query_openai(model_name, prompt_text(full_prompt), system_prompt, max_tokens, deadline=deadline)
+
+def query_claude(model_name, full_prompt, system_prompt, max_tokens, thinking_budget, temperature, echo=True, partial_file=None, deadline=None):
+    """
+    Queries Claude and waits for the response (see async_query_claude)
+    Returns:
+        dict: Response, tokens and costs
+    """
+    return run_async(async_query_claude(
+        model_name, full_prompt, system_prompt, max_tokens, thinking_budget, temperature,
+        echo=echo, partial_file=partial_file, deadline=deadline
+    ))
+
+def query_openai(model_name, full_prompt, system_prompt, max_tokens, deadline=None):
+    """
+    Queries an OpenAI model and waits for the response (see async_query_openai)
+    Returns:
+        dict: Response, tokens and costs
+    """
+    return run_async(async_query_openai(model_name, full_prompt, system_prompt, max_tokens, deadline=deadline))
+
+def _with_retries(fn, *args, **kwargs):
+    """Calls a blocking SDK method, retrying transient errors with the same policy as the queries"""
+    attempt = 0
+    while True:
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            if not run_async(should_retry(e, attempt)):
+                raise
+            attempt += 1
+
+def batch_query_claude(requests, poll_seconds=30):
+    """
+    Sends many Claude queries as one Message Batch and waits for the results.
+    Batches are billed at BATCH_PRICE_FACTOR and do not count against the interactive rate limits.
+    Args:
+        requests (dict): Maps a custom id ([a-zA-Z0-9_-], up to 64 characters) to the keyword
+            arguments of query_claude (model_name, full_prompt, system_prompt, max_tokens,
+            thinking_budget, temperature), plus optional ledger labels under "ledger" (e.g. {"run": ...})
+        poll_seconds (float): Seconds between status checks
+    Returns:
+        dict: Maps each custom id that succeeded to its response, tokens and costs
+    """
+    client = get_client("anthropic")
+
+    batch_requests = []
+    for custom_id, query in requests.items():
+        max_tokens = min(query["max_tokens"], MODEL_CONFIG[query["model_name"]]["max_output_tokens"])
+        batch_requests.append({
+            "custom_id": custom_id,
+            "params": claude_params(
+                query["model_name"], 
+                query["full_prompt"], 
+                query["system_prompt"], 
+                max_tokens, 
+                query["thinking_budget"], 
+                query["temperature"]
+            )
+        })
+
+    time_start = time.time()
+    batch = _with_retries(client.messages.batches.create, requests=batch_requests)
+    logging.info(f"Submitted message batch {batch.id} with {len(batch_requests)} requests")
+
+    # wait for the whole batch to finish
+    while batch.processing_status != "ended":
+        time.sleep(poll_seconds)
+        batch = _with_retries(client.messages.batches.retrieve, batch.id)
+        counts = batch.request_counts
+        logging.info(f"Batch {batch.id}: {counts.processing} processing, {counts.succeeded} succeeded, {counts.errored} errored")
+
+    results = {}
+    failed = []
+    for entry in _with_retries(client.messages.batches.results, batch.id):
+        if entry.result.type != "succeeded":
+            failed.append(f"{entry.custom_id} ({entry.result.type})")
+            continue
+
+        message = entry.result.message
+        response = "".join(block.text for block in message.content if block.type == "text")
+        results[entry.custom_id] = usage_to_llmdat(
+            response, 
+            requests[entry.custom_id]["model_name"],
+            input_tokens=message.usage.input_tokens,
+            output_tokens=message.usage.output_tokens,
+            cache_write_tokens=message.usage.cache_creation_input_tokens or 0,
+            cache_read_tokens=message.usage.cache_read_input_tokens or 0,
+            price_factor=BATCH_PRICE_FACTOR
+        )
+        # the latency of a batched call is the time until the whole batch ended
+        record_llm_call(
+            requests[entry.custom_id]["model_name"], 
+            results[entry.custom_id], 
+            time_start, 
+            time.time(), 
+            batch=True, 
+            metrics={"stop_reason": message.stop_reason, "retries": 0},
+            **requests[entry.custom_id].get("ledger", {})
+        )
+
+    # failed requests are left out, so the caller can retry them without losing the rest
+    if failed:
+        logging.warning(f"Message batch {batch.id} had failed requests: {', '.join(failed)}")
+
+    return results
+
+_bib_indexes = {}
+_bib_lock = threading.Lock()
+
+def _bib_surname(name):
+    """Last name of a bibtex author ("Last, First" or "First Last"), lowercase without braces or accents"""
+    name = re.sub(r"\\.|[{}]", "", name).strip()
+    surname = name.split(",")[0] if "," in name else name.split(" ")[-1]
+    return surname.strip().lower()
+
+def load_bib_index(bibtex_path):
+    """
+    Parses a bibtex file into an index of its entries (cached until the file changes)
+    Args:
+        bibtex_path (str): Path to the bibtex file
+    Returns:
+        dict: cite key -> {"surnames": author last names, "year": str, "text": the raw entry}
+    """
+    stat = os.stat(bibtex_path)
+    with _bib_lock:
+        cached = _bib_indexes.get(bibtex_path)
+        if cached is not None and cached[0] == (stat.st_mtime, stat.st_size):
+            return cached[1]
+
+        with open(bibtex_path, "r", encoding="utf-8") as f:
+            bibtex_content = f.read()
+
+        bib_index = {}
+        for entry in re.split(r"\n(?=@)", bibtex_content):
+            match = re.match(r"@\w+\s*\{\s*([^,\s]+)\s*,", entry.strip())
+            if not match:
+                continue
+            author = re.search(r"author\s*=\s*\{(.*?)\}\s*,?\s*\n", entry, re.DOTALL | re.IGNORECASE)
+            year = re.search(r"year\s*=\s*\{?\s*(\d{4})", entry, re.IGNORECASE)
+            bib_index[match.group(1)] = {
+                "surnames": [_bib_surname(name) for name in re.split(r"\s+and\s+", author.group(1))] if author else [],
+                "year": year.group(1) if year else "",
+                # drop the "% From lit-..." comments between entries
+                "text": re.sub(r"\n%[^\n]*", "", entry.strip()) + "\n"
+            }
+
+        _bib_indexes[bibtex_path] = ((stat.st_mtime, stat.st_size), bib_index)
+        return bib_index
+
+def match_bib_entries(text, bib_index):
+    """
+    Finds the bib entries cited in text, as "Author (Year)", "(Author et al., Year)", or by cite key
+    Args:
+        text (str): Markdown or latex text
+        bib_index (dict): Output of load_bib_index
+    Returns:
+        list: Matching cite keys, in bib file order
+    """
+    text_lower = text.lower()
+    matches = []
+    for key, entry in bib_index.items():
+        if re.search(rf"\b{re.escape(key.lower())}\b", text_lower):
+            matches.append(key)
+        elif entry["surnames"] and entry["year"]:
+            # the first author's name followed closely by the year
+            pattern = rf"\b{re.escape(entry['surnames'][0])}\b[^\n]{{0,80}}?\b{entry['year']}"
+            if re.search(pattern, text_lower):
+                matches.append(key)
+    return matches
+
+def unknown_citation_keys(latex, bib_index):
+    """Returns the keys in \\cite, \\citet, \\citep, ... commands that are not in the bib index"""
+    keys = []
+    for key_list in re.findall(r"\\cite[a-zA-Z]*\*?(?:\[[^\]]*\])*\{([^}]*)\}", latex):
+        keys.extend(key.strip() for key in key_list.split(",") if key.strip())
+    return sorted(set(key for key in keys if key not in bib_index))
+
+# replacements for the unicode characters pdflatex does not support (the ones the LLM conversion
+# prompt lists, plus typographic quotes and dashes); any other non-ascii character goes to the LLM
+MARKDOWN_UNICODE = {
+    "\u2605": "$\\star$",    # ★
+    "\u2080": "$_0$",         # ₀
+    "\u209c": "$_t$",         # ₜ
+    "\u2022": "\\textbullet{}",  # •
+    "\u2018": "`", "\u2019": "'", "\u201c": "``", "\u201d": "''",
+    "\u2013": "--", "\u2014": "---", "\u2026": "\\ldots{}", "\u00a0": "~"
+}
+
+# latex for the html that markdown produces from headings, paragraphs, emphasis and lists
+MARKDOWN_TAGS = {
+    "h1": ("\\section{", "}\n\n"),
+    "h2": ("\\subsection{", "}\n\n"),
+    "h3": ("\\subsubsection{", "}\n\n"),
+    "p": ("", "\n\n"),
+    "em": ("\\emph{", "}"),
+    "i": ("\\emph{", "}"),
+    "strong": ("\\textbf{", "}"),
+    "b": ("\\textbf{", "}"),
+    "code": ("\\texttt{", "}"),
+    "ul": ("\\begin{itemize}\n", "\\end{itemize}\n\n"),
+    "ol": ("\\begin{enumerate}\n", "\\end{enumerate}\n\n"),
+    "li": ("\\item ", "\n"),
+    "blockquote": ("\\begin{quote}\n", "\\end{quote}\n\n")
+}
 
-def response_to_texinput(response_raw, par_per_chunk=4, model_name="haiku", bibtex_raw='./lit-context/bibtex-all.bib'):
+LATEX_SPECIAL_CHARS = {"&": "\\&", "%": "\\%", "#": "\\#", "_": "\\_", "{": "\\{", "}": "\\}", "~": "\\textasciitilde{}", "<": "$<$", ">": "$>$"}
+
+class _MarkdownLatexParser(HTMLParser):
+    """Turns the html of a markdown chunk into latex, noting any tag that has no exact translation"""
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.unsupported = []
+        self.list_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag not in MARKDOWN_TAGS:
+            self.unsupported.append(tag)
+            return
+        if tag in ("ul", "ol"):
+            # a nested list starts on its own line, not glued to the text of its item
+            if self.list_depth > 0 and self.parts and not self.parts[-1].endswith("\n"):
+                self.parts.append("\n")
+            self.list_depth += 1
+        self.parts.append(MARKDOWN_TAGS[tag][0])
+
+    def handle_endtag(self, tag):
+        if tag not in MARKDOWN_TAGS:
+            return
+        end = MARKDOWN_TAGS[tag][1]
+        if tag in ("ul", "ol"):
+            self.list_depth -= 1
+            if self.list_depth > 0:
+                # no blank line inside the outer list
+                end = end.rstrip("\n") + "\n"
+        if tag == "li" and self.parts and self.parts[-1].endswith("\n"):
+            # the item already ends with a nested list
+            return
+        self.parts.append(end)
+
+    def handle_data(self, data):
+        # newlines between block tags are layout, the tag endings already add them
+        if not data.strip() and "\n" in data:
+            return
+        self.parts.append("".join(LATEX_SPECIAL_CHARS.get(char, char) for char in data))
+
+def markdown_to_latex(text):
     """
-    Converts raw text response to latex format using an LLM
+    Converts a markdown chunk to latex locally, if it only has headings (#, ##, ###), paragraphs,
+    emphasis, lists and $...$ / $$...$$ math. Anything ambiguous (tables, links, code blocks,
+    latex commands outside math, unbalanced dollar signs, unknown unicode) returns None, so
+    the chunk goes to the LLM instead.
+    Args:
+        text (str): Markdown chunk
+    Returns:
+        str: latex, or None if the chunk is not simple
+    """
+    # set the math aside, so markdown does not read * and _ in it as emphasis
+    math = []
+    def stash(latex):
+        math.append(latex)
+        return f"MATHSTASH{len(math) - 1}X"
+
+    # display math on its own lines becomes an align environment; display math inside a
+    # sentence stays where it is as \[...\], so the paragraph is not broken up
+    def display_math(m):
+        body = (m.group(1) or m.group(2)).strip()
+        line_before = m.string[:m.start()].rsplit("\n", 1)[-1]
+        line_after = m.string[m.end():].split("\n", 1)[0]
+        if line_before.strip() or line_after.strip():
+            return stash(f"\\[{body}\\]")
+        return stash("\\begin{align}\n" + body + "\n\\end{align}")
+
+    text = re.sub(r"\$\$(.+?)\$\$|\\\[(.+?)\\\]", display_math, text, flags=re.DOTALL)
+    text = re.sub(r"\\begin\{(align\*?|equation\*?)\}.+?\\end\{\1\}", lambda m: stash(m.group(0)), text, flags=re.DOTALL)
+    # inline math as pandoc reads it: no space inside the dollar signs, no digit right after
+    text = re.sub(r"\$(?=\S)([^$\n]+?)(?<=\S)\$(?!\d)", lambda m: stash(m.group(0)), text)
+    text = re.sub(r"\\\((.+?)\\\)", lambda m: stash(f"${m.group(1)}$"), text)
+
+    # what is left must be plain text: no dollar signs (currency?), latex commands, math
+    # written without dollar signs, or pipe tables (which markdown leaves as text)
+    if "$" in text or "\\" in text or "^" in text or re.search(r"^\s*\|", text, re.MULTILINE):
+        return None
+
+    for char, latex in MARKDOWN_UNICODE.items():
+        text = text.replace(char, stash(latex))
+    if not text.isascii():
+        return None
+
+    parser = _MarkdownLatexParser()
+    parser.feed(markdown.markdown(text))
+    parser.close()
+    if parser.unsupported:
+        return None
+
+    latex = "".join(parser.parts)
+    latex = re.sub(r"MATHSTASH(\d+)X", lambda m: math[int(m.group(1))], latex)
+    latex = re.sub(r"\n{3,}", "\n\n", latex)
+    return latex.strip() + "\n"
+
+def response_to_texinput(response_raw, par_per_chunk=4, model_name="haiku", bibtex_raw='./lit-context/bibtex-all.bib', max_workers=8):
+    """
+    Converts raw text response to latex format, locally for simple sections and using an LLM for the rest
     
     Args:
         response_raw (str): Raw text to convert to latex
         par_per_chunk (int): Number of sections to combine into each chunk
         model_name (str): Name of the model to use for conversion
-        bibtex_raw (str): Path to bibtex file to use for citations
+        bibtex_raw (str): Path to bibtex file to use for citations (each section gets only the entries it cites)
+        max_workers (int): Number of sections to convert at once (on the event loop)
     Returns:
-        dict: Contains converted latex response and usage statistics
+        dict: Contains converted latex response, usage statistics and unknown_citations (cite keys not in the bibtex file)
     """
     # Initialize return structure
-    llmdat_tex = {
-        "response": "",
-        "input_tokens": 0,
-        "output_tokens": 0,
-        "input_cost": 0.0,
-        "output_cost": 0.0,
-        "total_cost": 0.0
-    }
+    llmdat_tex = empty_llmdat()
 
     # Replace section numbers in headers (e.g., # 2. Model or ### 2.1 Model Setup)
     response_raw = re.sub(r'(#{1,3})\s+\d+\.?\d*\.?\s+', r'\1 ', response_raw)
@@ -265,16 +1879,25 @@ def response_to_texinput(response_raw, par_per_chunk=4, model_name="haiku", bibt
         par_per_chunk = min(par_per_chunk, len(paragraphs))
         sections = [paragraphs[i:i+par_per_chunk] for i in range(0, len(paragraphs), par_per_chunk)]
 
-    # read in the bibtex file (if supplied)
-    if bibtex_raw:
-        with open(bibtex_raw, 'r', encoding='utf-8') as f:
-            bibtex_content = f.read()
-    else:
-        bibtex_content = ""
+    # index the bibtex file (if supplied), each section only gets the entries it cites
+    bib_index = load_bib_index(bibtex_raw) if bibtex_raw else {}
     
-    tex_sections = []
-    for i, section in enumerate(sections):
+    # sections with only headings, paragraphs, emphasis, lists and math are converted locally,
+    # the rest (and any that cite papers, which need \\citet and \\citep) go to the llm
+    section_texts = [section if isinstance(section, str) else "\n\n".join(section) for section in sections]
+    local_tex = [None if match_bib_entries(text, bib_index) else markdown_to_latex(text) for text in section_texts]
+    logging.info(f"Converting {sum(tex is not None for tex in local_tex)} of {len(sections)} sections locally, the rest with {model_name}")
+
+    async def convert_section(i, section):
+        if local_tex[i] is not None:
+            llmdat_section = empty_llmdat(local_tex[i])
+            llmdat_section["unknown_citations"] = []
+            return llmdat_section
+
         print(f"  converting section {i+1} of {len(sections)}")
+
+        cited_keys = match_bib_entries(str(section), bib_index)
+        bibtex_content = "\n".join(bib_index[key]["text"] for key in cited_keys)
         
         prompt_tex = f"""
         <input-document>
@@ -301,21 +1924,40 @@ def response_to_texinput(response_raw, par_per_chunk=4, model_name="haiku", bibt
         """
 
         # use an llm to convert to latex
-        temp_out = query_claude(
+        llmdat_section = await async_query_claude(
             model_name, 
             prompt_tex, 
             max_tokens=20000, 
             temperature=0.2, 
             system_prompt="Output only latex code.", 
-            thinking_budget=0
+            thinking_budget=0,
+            echo=max_workers == 1
         )
 
+        # check the cite keys locally, before biber does
+        if bib_index:
+            unknown_keys = unknown_citation_keys(llmdat_section["response"], bib_index)
+            if unknown_keys:
+                logging.warning(f"Section {i+1} cites keys not in {bibtex_raw}: {', '.join(unknown_keys)}")
+            llmdat_section["unknown_citations"] = unknown_keys
+        return llmdat_section
+
+    async def convert_all():
+        semaphore = asyncio.Semaphore(max(1, max_workers))
+        async def convert_limited(i, section):
+            async with semaphore:
+                return await convert_section(i, section)
+        return await asyncio.gather(*[convert_limited(i, section) for i, section in enumerate(sections)])
+
+    # convert the sections concurrently on the event loop, results come back in section order
+    section_outs = run_async(convert_all())
+
+    tex_sections = []
+    llmdat_tex["unknown_citations"] = []
+    for temp_out in section_outs:
         # accumulate the costs and tokens
-        llmdat_tex["input_tokens"] += temp_out["input_tokens"]
-        llmdat_tex["output_tokens"] += temp_out["output_tokens"]
-        llmdat_tex["input_cost"] += temp_out["input_cost"]
-        llmdat_tex["output_cost"] += temp_out["output_cost"]
-        llmdat_tex["total_cost"] += temp_out["total_cost"]
+        add_llmdat(llmdat_tex, temp_out)
+        llmdat_tex["unknown_citations"] += temp_out.get("unknown_citations", [])
         
         # collect the latex sections
         tex_sections.append(temp_out["response"])
@@ -343,8 +1985,65 @@ def texinput_to_pdf(texinput, pdf_fname, output_folder="./responses/"):
     
     return compile_result
 
-def tex_to_pdf(pdf_fname, output_folder="./responses/"):
+# LaTeX build settings: pdflatex reruns stop once these files stop changing
+LATEX_CONFIG = {
+    "max_passes": 5,
+    "converge_exts": ["aux", "toc", "out", "bbl", "bcf"]
+}
+
+def _file_hash(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def _latex_log_errors(log_path):
+    """Returns the "! ..." error lines of a pdflatex log, with the line after each"""
+    if not os.path.exists(log_path):
+        return []
+    with open(log_path, "r", encoding="utf-8", errors="replace") as f:
+        lines = f.read().splitlines()
+    return [
+        " ".join(line.strip() for line in lines[i:i+2])
+        for i, line in enumerate(lines) if line.startswith("!")
+    ]
 
+def _bcf_citekeys(bcf_path):
+    """Returns the sorted cite keys in a biblatex .bcf file (empty if there is no .bcf)"""
+    if not os.path.exists(bcf_path):
+        return []
+    with open(bcf_path, "r", encoding="utf-8", errors="replace") as f:
+        return sorted(set(re.findall(r"<bcf:citekey[^>]*>([^<]+)</bcf:citekey>", f.read())))
+
+def _run_latex_tool(tool, command, passes, draft=False):
+    """Runs one build pass and records its tool, time, and return code in passes"""
+    print(f"Running {tool}{' (draft)' if draft else ''}: {' '.join(command)}")
+    if shutil.which(command[0]) is None:
+        passes.append({"tool": tool, "draft": draft, "seconds": 0.0, "returncode": 127})
+        return 127
+
+    time_start = time.time()
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, errors="replace")
+    passes.append({"tool": tool, "draft": draft, "seconds": time.time() - time_start, "returncode": result.returncode})
+    if result.returncode != 0:
+        # show the end of the tool output, where the error is
+        print("\n".join(result.stdout.splitlines()[-20:]))
+    return result.returncode
+
+def tex_to_pdf(pdf_fname, output_folder="./responses/"):
+    """
+    Compiles {output_folder}{pdf_fname}.tex to pdf.
+    The first pdflatex pass runs in draft mode. Biber runs only if the document cites something,
+    and again only if the citations change. If biber fails, the pdf is still built (with
+    unresolved citations) and the returncode is pdflatex's. pdflatex reruns until the aux,
+    toc, out, bbl, and bcf files stop changing (usually two passes in total).
+    Args:
+        pdf_fname (str): Name of the .tex file, without the extension
+        output_folder (str): Folder with the .tex file, also gets the pdf
+    Returns:
+        dict: returncode (0 on success), passes (tool, draft, seconds, returncode for each pass),
+            errors (error lines from the logs), seconds (total build time)
+    """
     # -- clean aux files --
     base_files = [
         f"{pdf_fname}.aux",
@@ -362,25 +2061,57 @@ def tex_to_pdf(pdf_fname, output_folder="./responses/"):
     for file in aux_files:
         if os.path.exists(file):
             os.remove(file)
-    
-    # -- compile --
-    # Compile with bibliography support
-    compile_command = f"pdflatex -interaction=nonstopmode -halt-on-error -output-directory={output_folder} {output_folder}{pdf_fname}.tex"
-    print(f"Running first LaTeX pass: {compile_command}")
-    os.system(compile_command)
-
-    # Run Biber without changing directory
-    biber_command = f"biber {output_folder}{pdf_fname}"
-    print(f"Running Biber: {biber_command}")
-    os.system(biber_command)
-
-    # Run LaTeX again (twice) to resolve references
-    print("Running second LaTeX pass...")
-    os.system(compile_command)
 
-    print("Running final LaTeX pass...")
-    compile_result = os.system(compile_command)
-    print(f"LaTeX compilation result: {compile_result}")
+    # -- compile --
+    base_path = f"{output_folder}{pdf_fname}"
+    latex_command = ["pdflatex", "-interaction=nonstopmode", "-halt-on-error", f"-output-directory={output_folder}", f"{base_path}.tex"]
+    converge_files = [f"{base_path}.{ext}" for ext in LATEX_CONFIG["converge_exts"]]
+
+    time_start = time.time()
+    passes = []
+    errors = []
+    biber_citekeys = None
+
+    # the first pass only writes the aux files, so it skips making the pdf
+    returncode = _run_latex_tool("pdflatex", latex_command[:1] + ["-draftmode"] + latex_command[1:], passes, draft=True)
+    converged = False
+    while returncode == 0 and not converged:
+        # run biber if the cited keys changed since its last run (a document with no citations never needs it)
+        citekeys = _bcf_citekeys(f"{base_path}.bcf")
+        if citekeys and citekeys != biber_citekeys:
+            biber_citekeys = citekeys
+            biber_returncode = _run_latex_tool("biber", ["biber", base_path], passes)
+            if biber_returncode != 0:
+                # the pdf is still made, with unresolved citations
+                biber_error = "biber not found" if biber_returncode == 127 else f"biber failed, see {base_path}.blg"
+                logging.warning(f"{biber_error}; building the pdf with unresolved citations")
+                errors.append(biber_error)
+
+        if len([p for p in passes if p["tool"] == "pdflatex"]) >= LATEX_CONFIG["max_passes"]:
+            errors.append(f"aux files did not converge after {LATEX_CONFIG['max_passes']} pdflatex passes")
+            break
+
+        hashes_before = [_file_hash(file) for file in converge_files]
+        returncode = _run_latex_tool("pdflatex", latex_command, passes)
+        converged = hashes_before == [_file_hash(file) for file in converge_files]
+
+    if returncode == 127:
+        errors.append(f"{passes[-1]['tool']} not found")
+    elif returncode != 0:
+        errors.extend(_latex_log_errors(f"{base_path}.log") or [f"pdflatex failed with return code {returncode}"])
+
+    compile_result = {
+        "returncode": returncode,
+        "passes": passes,
+        "errors": errors,
+        "seconds": time.time() - time_start
+    }
+    print(
+        f"LaTeX compilation result: {returncode} after {len(passes)} passes "
+        f"({', '.join(p['tool'] for p in passes)}) in {compile_result['seconds']:.1f}s"
+    )
+    for error in errors:
+        print(f"LaTeX error: {error}")
 
     # remove aux files 
     # pause to avoid deleting aux files too quickly
@@ -392,103 +2123,747 @@ def tex_to_pdf(pdf_fname, output_folder="./responses/"):
 
     return compile_result
 
-def save_costs(prompts, index, llmdat, llmdat_texinput, latex_model, output_folder="./responses/"):
-    # save cost data for both llmdat and llmdat_texinput
-    costs_data = {
-        'Operation': ['Main', 'LaTeX'],
-        'Model': [prompts[index]['model_name'], latex_model],
-        'Input_Tokens': [llmdat['input_tokens'], llmdat_texinput['input_tokens']],
-        'Output_Tokens': [llmdat['output_tokens'], llmdat_texinput['output_tokens']],
-        'Input_Cost': [llmdat['input_cost'], llmdat_texinput['input_cost']],
-        'Output_Cost': [llmdat['output_cost'], llmdat_texinput['output_cost']],
-        'Total_Cost': [llmdat['total_cost'], llmdat_texinput['total_cost']]
-    }
-    
-    cost_df = pd.DataFrame(costs_data)
-    
-    # Format numeric columns
-    cost_df['Input_Tokens'] = cost_df['Input_Tokens'].apply(lambda x: f"{x:,}")
-    cost_df['Output_Tokens'] = cost_df['Output_Tokens'].apply(lambda x: f"{x:,}")
-    cost_df['Input_Cost'] = cost_df['Input_Cost'].apply(lambda x: f"${x:.4f}")
-    cost_df['Output_Cost'] = cost_df['Output_Cost'].apply(lambda x: f"${x:.4f}")
-    cost_df['Total_Cost'] = cost_df['Total_Cost'].apply(lambda x: f"${x:.4f}")
-
-    # Save DataFrame with formatted columns
-    with open(f"{output_folder}{prompts[index]['name']}-costs.txt", "w", encoding="utf-8") as f:
-        f.write(cost_df.to_string(
-            index=False,
-            justify='left',
-            col_space={
-                'Operation': 10,
-                'Model': 10,
-                'Input_Tokens': 15,
-                'Output_Tokens': 15,
-                'Input_Cost': 12,
-                'Output_Cost': 12,
-                'Total_Cost': 12
-            }
-        ))        
-    
-    return cost_df
+def costs_report(costs_df):
+    """
+    Formats ledger rows as a cost table by prompt, operation and model
+    Args:
+        costs_df (pd.DataFrame): Rows from ledger_dataframe
+    Returns:
+        tuple: (report_df, grand_total) where report_df is the formatted table
+    """
+    report_df = costs_df.groupby(["prompt", "operation", "model"], as_index=False, sort=False).agg(
+        Calls=("id", "count"),
+        Input_Tokens=("input_tokens", "sum"),
+        Output_Tokens=("output_tokens", "sum"),
+        Cache_Write_Tokens=("cache_write_tokens", "sum"),
+        Cache_Read_Tokens=("cache_read_tokens", "sum"),
+        Input_Cost=("input_cost", "sum"),
+        Output_Cost=("output_cost", "sum"),
+        Cache_Write_Cost=("cache_write_cost", "sum"),
+        Cache_Read_Cost=("cache_read_cost", "sum"),
+        Total_Cost=("total_cost", "sum"),
+        Seconds=("latency_seconds", "sum")
+    )
+    report_df["Cache_Cost"] = report_df.pop("Cache_Write_Cost") + report_df.pop("Cache_Read_Cost")
+    report_df = report_df.rename(columns={"prompt": "Prompt", "operation": "Operation", "model": "Model"})
+    report_df = report_df[[
+        "Prompt", "Operation", "Model", "Calls", "Input_Tokens", "Output_Tokens", "Cache_Write_Tokens", "Cache_Read_Tokens",
+        "Input_Cost", "Output_Cost", "Cache_Cost", "Total_Cost", "Seconds"
+    ]]
+    grand_total = report_df["Total_Cost"].sum()
+
+    # Format numeric columns for display
+    for col in ["Input_Tokens", "Output_Tokens", "Cache_Write_Tokens", "Cache_Read_Tokens"]:
+        report_df[col] = report_df[col].apply(lambda x: f"{x:,.0f}")
+    for col in ["Input_Cost", "Output_Cost", "Cache_Cost", "Total_Cost"]:
+        report_df[col] = report_df[col].apply(lambda x: f"${x:.4f}")
+    report_df["Seconds"] = report_df["Seconds"].apply(lambda x: f"{x:.1f}")
+
+    return report_df, grand_total
 
-def aggregate_costs(output_folder="./responses/"):
+def save_costs(step, output_folder="./responses/"):
     """
-    Aggregates costs from all *-costs.txt files in the output directory.
+    Writes {name}-costs.txt for a step from the ledger rows of its latest execution
+    """
+    costs_df = ledger_dataframe(run=step["run"], prompt=step["name"])
+    costs_df = costs_df[costs_df["started"] >= step["prepared"]]
+    report_df, grand_total = costs_report(costs_df)
+
+    with open(f"{output_folder}{step['name']}-costs.txt", "w", encoding="utf-8") as f:
+        f.write(f"Total: ${grand_total:.4f}\n")
+        f.write(report_df.to_string(index=False, justify='left'))
+
+def aggregate_costs(output_folder="./responses/", since=None):
+    """
+    Aggregates the costs of the steps in an output folder. By default, these are the ledger rows
+    of the execution that produced each step recorded in the manifest, whenever it ran (a resumed
+    run, or a forked run whose shared steps ran in the prefix folder, still reports every step).
     
     Args:
-        output_folder (str): Directory containing the cost files
+        output_folder (str): Output folder of the run
+        since (str): Instead, count every call for the folder started at or after this UTC
+            isoformat time, e.g. the start of this execution
         
     Returns:
         tuple: (costs_df, grand_total) where:
-            - costs_df: DataFrame containing all cost data
-            - grand_total: float of total costs across all files
+            - costs_df: DataFrame with the costs by prompt, operation and model
+            - grand_total: float of total costs across all calls
     """
-    # find all *costs.txt files
-    costs_files = glob.glob(f"{output_folder}*-costs.txt")
-    
-    # read all costs files into a dataframe
-    costs_data = []
-    for cost_file in costs_files:
-        # Read the file into a DataFrame with explicit column names
-        df = pd.read_csv(cost_file, delim_whitespace=True, 
-                        names=['Operation', 'Model', 'Input_Tokens', 'Output_Tokens', 
-                              'Input_Cost', 'Output_Cost', 'Total_Cost'])
-        
-        # Add filename as reference
-        df['filename'] = os.path.basename(cost_file)
-        
-        # Clean up numeric columns - handle both string and numeric values
-        for col in ['Input_Tokens', 'Output_Tokens']:
-            if df[col].dtype == 'object':  # Only process if it's a string column
-                df[col] = df[col].str.replace(',', '')
-            df[col] = pd.to_numeric(df[col], errors='coerce')
-                
-        for col in ['Input_Cost', 'Output_Cost', 'Total_Cost']:
-            if df[col].dtype == 'object':  # Only process if it's a string column
-                df[col] = df[col].str.replace('$', '')
-            df[col] = pd.to_numeric(df[col], errors='coerce')
-        
-        costs_data.append(df)
-    
-    # Combine all dataframes
-    costs_df = pd.concat(costs_data, ignore_index=True)
-    
-    # Reorder columns to match the original format
-    column_order = ['filename', 'Operation', 'Model', 'Input_Tokens', 'Output_Tokens', 
-                   'Input_Cost', 'Output_Cost', 'Total_Cost']
-    costs_df = costs_df[column_order]
-    
-    # Format numeric columns for display
-    costs_df['Input_Tokens'] = costs_df['Input_Tokens'].apply(lambda x: f"{x:,.0f}")
-    costs_df['Output_Tokens'] = costs_df['Output_Tokens'].apply(lambda x: f"{x:,.0f}")
-    costs_df['Input_Cost'] = costs_df['Input_Cost'].apply(lambda x: f"${x:.4f}")
-    costs_df['Output_Cost'] = costs_df['Output_Cost'].apply(lambda x: f"${x:.4f}")
-    costs_df['Total_Cost'] = costs_df['Total_Cost'].apply(lambda x: f"${x:.4f}")
-    
-    # Calculate grand total using numeric values
-    grand_total = pd.to_numeric(costs_df['Total_Cost'].str.replace('$', ''), errors='coerce').sum()
-    
-    return costs_df, grand_total
+    if since is not None:
+        costs_df = ledger_dataframe(run=ledger_run_name(output_folder))
+        return costs_report(costs_df[costs_df["started"] >= since])
+
+    step_dfs = []
+    for step_name, entry in load_manifest(output_folder).items():
+        ledger = entry.get("ledger")
+        if ledger is None or not os.path.exists(f"{output_folder}{step_name}-response.md"):
+            continue
+        step_df = ledger_dataframe(run=ledger["run"], prompt=step_name)
+        step_dfs.append(step_df[(step_df["started"] >= ledger["started"]) & (step_df["started"] <= ledger["ended"])])
+    costs_df = pd.concat(step_dfs, ignore_index=True) if step_dfs else pd.DataFrame(columns=["id"] + LEDGER_COLUMNS)
+    return costs_report(costs_df)
+
+def save_all_costs(output_folder, since=None):
+    """
+    Writes all-costs.txt for an output folder: the total and table of aggregate_costs, and if
+    since is given, a line with the cost of the calls made since then (this execution)
+    """
+    costs_df, grand_total = aggregate_costs(output_folder)
+    with open(f"{output_folder}all-costs.txt", "w", encoding="utf-8") as f:
+        f.write(f"Grand Total: ${grand_total:.4f}\n")
+        if since is not None:
+            f.write(f"This execution: ${aggregate_costs(output_folder, since=since)[1]:.4f}\n")
+        f.write(costs_df.to_string(index=False))
+
+# Dry-run forecasts: token counts of context files are cached here, keyed by path, size and mtime
+FORECAST_CONFIG = {
+    "token_cache_file": "./temp/token-counts.json",
+    "tokens_per_second": 50,
+    "latex_model": "haiku",
+    "latex_overhead_tokens": 1000
+}
+
+_token_counts_lock = threading.Lock()
+
+def file_tokens(paths):
+    """
+    Counts the tokens of files locally (estimate_tokens), reusing the cached count of unchanged files
+    Args:
+        paths (list): File paths
+    Returns:
+        dict: Maps each path to its token count
+    """
+    cache_file = FORECAST_CONFIG["token_cache_file"]
+    with _token_counts_lock:
+        token_counts = {}
+        if os.path.exists(cache_file):
+            with open(cache_file, "r", encoding="utf-8") as f:
+                token_counts = json.load(f)
+
+        counts = {}
+        changed = False
+        for path in paths:
+            stat = os.stat(path)
+            signature = f"{stat.st_size}:{stat.st_mtime}"
+            entry = token_counts.get(path)
+            if entry is None or entry["signature"] != signature:
+                with open(path, "r", encoding="utf-8") as f:
+                    entry = {"signature": signature, "tokens": estimate_tokens(f.read())}
+                token_counts[path] = entry
+                changed = True
+            counts[path] = entry["tokens"]
+
+        if changed:
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+            with open(f"{cache_file}.tmp", "w", encoding="utf-8") as f:
+                json.dump(token_counts, f)
+            os.replace(f"{cache_file}.tmp", cache_file)
+    return counts
+
+def forecast_plan(plan_name, config, prompts, indices, output_folder=None, max_concurrency=1, price_factor=1.0):
+    """
+    Projects the tokens, cost and wall time of running the selected steps of a plan, without
+    calling any model. Input tokens are counted locally. Responses that the run has not produced
+    yet are estimated from the ledger (the average output of the same prompt in earlier runs
+    of the plan), or from max_tokens if there is no history. Input is priced at the full rate
+    (prompt cache savings are ignored), so the cost is an upper bound when there is no history.
+    Args:
+        plan_name (str): Name of the plan (for the ledger history)
+        config (dict): Plan config
+        prompts (list): List of prompt dicts from the plan yaml
+        indices (list): Indices of the steps to run
+        output_folder (str): Folder with responses from earlier steps (None for a fresh run)
+        max_concurrency (int): Number of independent steps run at once
+        price_factor (float): Multiplier on the prices (e.g. BATCH_PRICE_FACTOR)
+    Returns:
+        tuple: (forecast_df, totals) where forecast_df has one row per step and totals is a dict
+            with input_tokens, context_saved_tokens (input left out by `context` keys, compared
+            with giving every prompt all earlier responses), output_tokens, cost and seconds
+    """
+    deps = build_prompt_dag(prompts)
+    ancestors = prompt_ancestors(prompts, deps)
+    context_names = select_context(prompts, ancestors)
+    names_run = [prompts[index]["name"] for index in indices]
+
+    # history of earlier runs of this plan
+    history_df = ledger_dataframe(plan=plan_name)
+    history_df = history_df[history_df["cache_hit"] == 0]
+    main_df = history_df[history_df["operation"] == "Main"]
+    prompt_history = main_df.groupby("prompt").agg(output_tokens=("output_tokens", "mean"), seconds=("latency_seconds", "mean"))
+    model_speed = ledger_summary(by=("model",))
+    model_speed = dict(zip(model_speed["model"], model_speed["output_tokens_per_second"]))
+
+    # actual token counts of the responses that already exist and are not rerun
+    existing = {}
+    for prompt in prompts:
+        path = f"{output_folder}{prompt['name']}-response.md" if output_folder else None
+        if prompt["name"] not in names_run and path is not None and os.path.exists(path):
+            existing[prompt["name"]] = file_tokens([path])[path]
+
+    rows = []
+    output_tokens = {}
+    for index, prompt in enumerate(prompts):
+        name = prompt["name"]
+        max_tokens = prompt.get("max_tokens", config["max_tokens"]) + prompt.get("thinking_budget", config["thinking_budget"])
+        if name in existing:
+            output_tokens[name], source = existing[name], "existing"
+        elif name in prompt_history.index:
+            output_tokens[name], source = int(prompt_history.loc[name, "output_tokens"]), "history"
+        else:
+            output_tokens[name], source = max_tokens, "max_tokens"
+        if index not in indices:
+            continue
+
+        # input: system prompt, instructions, context files, earlier responses
+        use_system_prompt = prompt.get("use_system_prompt", config["use_system_prompt"])
+        files = [f"./lit-context/{fname}" for fname in prompt.get("lit_files", [])]
+        files += [f"./latex-input/{fname}" for fname in prompt.get("latex_files", [])]
+        input_tokens = (
+            estimate_tokens(config["system_prompt"] if use_system_prompt else "")
+            + estimate_tokens(prompt["instructions"])
+            + sum(file_tokens(files).values())
+            + sum(output_tokens[dep] for dep in context_names[name])
+        )
+        # the earlier responses left out by the prompt's `context` key
+        context_saved_tokens = sum(output_tokens[dep] for dep in ancestors[name] if dep not in context_names[name])
+
+        model = MODEL_CONFIG[prompt["model_name"]]
+        cost = (input_tokens * model["input"] + output_tokens[name] * model["output"]) * price_factor
+
+        # LaTeX conversion reads and rewrites the whole response
+        if config["convert_all_latex"]:
+            latex_model = MODEL_CONFIG[FORECAST_CONFIG["latex_model"]]
+            cost += (
+                (output_tokens[name] + FORECAST_CONFIG["latex_overhead_tokens"]) * latex_model["input"]
+                + output_tokens[name] * latex_model["output"]
+            )
+
+        if name in prompt_history.index:
+            seconds = float(prompt_history.loc[name, "seconds"])
+        else:
+            tokens_per_second = model_speed.get(prompt["model_name"])
+            if tokens_per_second is None or pd.isna(tokens_per_second):
+                tokens_per_second = FORECAST_CONFIG["tokens_per_second"]
+            seconds = output_tokens[name] / tokens_per_second
+
+        rows.append({
+            "prompt": name,
+            "model": prompt["model_name"],
+            "input_tokens": input_tokens,
+            "context_saved_tokens": context_saved_tokens,
+            "output_tokens": output_tokens[name],
+            "output_source": source,
+            "cost": cost,
+            "seconds": seconds
+        })
+
+    forecast_df = pd.DataFrame(rows, columns=["prompt", "model", "input_tokens", "context_saved_tokens", "output_tokens", "output_source", "cost", "seconds"])
+
+    # wall time: the sum of the steps, or the longest dependency chain when steps run in parallel
+    if max_concurrency > 1 and rows:
+        step_seconds = {prompt["name"]: 0.0 for prompt in prompts}
+        step_seconds.update(dict(zip(forecast_df["prompt"], forecast_df["seconds"])))
+        wall_seconds = max(critical_path_priority(prompts, deps, step_seconds).values())
+    else:
+        wall_seconds = forecast_df["seconds"].sum()
+
+    totals = {
+        "input_tokens": int(forecast_df["input_tokens"].sum()),
+        "context_saved_tokens": int(forecast_df["context_saved_tokens"].sum()),
+        "output_tokens": int(forecast_df["output_tokens"].sum()),
+        "cost": float(forecast_df["cost"].sum()),
+        "seconds": float(wall_seconds)
+    }
+    return forecast_df, totals
+
+def print_forecast(forecast_df, totals, n_runs=1, wall_factor=1):
+    """
+    Prints a forecast from forecast_plan, scaled to n_runs runs
+    Args:
+        wall_factor (int): Number of runs that run one after another (n_runs / jobs)
+    """
+    report_df = forecast_df.copy()
+    report_df["input_tokens"] = report_df["input_tokens"].apply(lambda x: f"{x:,}")
+    report_df["context_saved_tokens"] = report_df["context_saved_tokens"].apply(lambda x: f"{x:,}")
+    report_df["output_tokens"] = report_df["output_tokens"].apply(lambda x: f"{x:,}")
+    report_df["cost"] = report_df["cost"].apply(lambda x: f"${x:.4f}")
+    report_df["seconds"] = report_df["seconds"].apply(lambda x: f"{x:.0f}")
+    print(report_df.to_string(index=False))
+    print(f"\nPer run: {totals['input_tokens']:,} input tokens, {totals['output_tokens']:,} output tokens, ${totals['cost']:.4f}, {totals['seconds']/60:.1f} min")
+    if totals["context_saved_tokens"] > 0:
+        print(f"Selective context leaves out {totals['context_saved_tokens']:,} input tokens per run ({totals['context_saved_tokens'] / (totals['input_tokens'] + totals['context_saved_tokens']):.0%} of the input)")
+    if n_runs > 1:
+        print(f"{n_runs} runs: ${totals['cost']*n_runs:.4f}, {totals['seconds']*wall_factor/60:.1f} min")
+
+def load_plan(plan_name):
+    """
+    Loads the config and prompts of a plan
+    Returns:
+        tuple: (config, prompts)
+    """
+    with open(f"{plan_name}.yaml", "r") as f:
+        temp = yaml.safe_load(f)
+    return temp["config"], temp["prompts"]
+
+# keys every plan must set (system_prompt only if a prompt uses it)
+PLAN_CONFIG_KEYS = ["run_range", "temperature", "convert_all_latex", "max_tokens", "thinking_budget", "use_system_prompt"]
+PLAN_PROMPT_KEYS = ["name", "model_name", "instructions"]
+
+# smallest thinking budget the API accepts
+MIN_THINKING_BUDGET = 1024
+
+def compile_plan(plan_name, output_folder=None):
+    """
+    Loads a plan and checks everything that would otherwise fail partway through a run:
+    config keys, model names (including fallback_models), max_tokens against max_output_tokens,
+    thinking budgets, lit_files and latex_files paths, depends_on and context. All problems
+    are reported at once.
+    Args:
+        plan_name (str): Name of the plan
+        output_folder (str): If given, the execution plan is saved there as execution-plan.json
+    Returns:
+        dict: Execution plan with the config and prompts, the dependency graph (deps), the
+            context of each prompt, the indices of the steps in the run range, and the resolved
+            settings and file paths of each step (steps)
+    Raises:
+        ValueError: If the plan has problems, listing each one
+    """
+    config, prompts = load_plan(plan_name)
+    errors = []
+
+    for key in PLAN_CONFIG_KEYS:
+        if key not in config:
+            errors.append(f"config: missing {key}")
+    for index, prompt in enumerate(prompts):
+        for key in PLAN_PROMPT_KEYS:
+            if key not in prompt:
+                errors.append(f"prompt {index+1}: missing {key}")
+    if errors:
+        raise ValueError(f"Plan {plan_name} is not valid:\n  " + "\n  ".join(errors))
+
+    run_range = config["run_range"]
+    if not 1 <= run_range["start"] <= min(run_range["end"], len(prompts)):
+        errors.append(f"config: run_range {run_range['start']} to {run_range['end']} does not fit {len(prompts)} prompts")
+
+    deps, context = {}, {}
+    try:
+        deps = build_prompt_dag(prompts)
+        context = select_context(prompts, prompt_ancestors(prompts, deps))
+    except ValueError as e:
+        errors.append(str(e))
+
+    steps = []
+    for index, prompt in enumerate(prompts):
+        name = prompt["name"]
+        models = [prompt["model_name"]] + prompt.get("fallback_models", config.get("fallback_models", []))
+        max_tokens = prompt.get("max_tokens", config["max_tokens"])
+        thinking_budget = prompt.get("thinking_budget", config["thinking_budget"])
+
+        if not (prompt["instructions"] or "").strip():
+            errors.append(f"{name}: no instructions")
+        if prompt.get("use_system_prompt", config["use_system_prompt"]) and not config.get("system_prompt"):
+            errors.append(f"{name}: uses the system prompt, but the config has no system_prompt")
+
+        for model in models:
+            if model not in MODEL_CONFIG:
+                errors.append(f"{name}: unknown model {model} (known: {', '.join(MODEL_CONFIG)})")
+                continue
+            if max_tokens > MODEL_CONFIG[model]["max_output_tokens"]:
+                errors.append(f"{name}: max_tokens {max_tokens} is above the {MODEL_CONFIG[model]['max_output_tokens']} limit of {model}")
+            # OpenAI fallbacks are queried without the budget, so only Claude fallbacks must take it
+            is_openai_fallback = model != prompt["model_name"] and MODEL_CONFIG[model]["type"] == "openai"
+            if thinking_budget > 0 and not MODEL_CONFIG[model]["thinking"] and not is_openai_fallback:
+                errors.append(f"{name}: {model} does not take a thinking_budget (set it to 0)")
+
+        if thinking_budget > 0 and not MIN_THINKING_BUDGET <= thinking_budget < max_tokens:
+            errors.append(f"{name}: thinking_budget {thinking_budget} must be at least {MIN_THINKING_BUDGET} and below max_tokens {max_tokens}")
+
+        files = [f"./lit-context/{fname}" for fname in prompt.get("lit_files") or []]
+        files += [f"./latex-input/{fname}" for fname in prompt.get("latex_files") or []]
+        for path in files:
+            if not os.path.isfile(path):
+                errors.append(f"{name}: file not found {path}")
+
+        steps.append({
+            "index": index,
+            "name": name,
+            "models": models,
+            "max_tokens": max_tokens,
+            "thinking_budget": thinking_budget,
+            "temperature": config["temperature"],
+            "depends_on": deps.get(name, []),
+            "context": context.get(name, []),
+            "files": files,
+            "deadline_seconds": prompt.get("deadline_seconds", config.get("deadline_seconds"))
+        })
+
+    if errors:
+        raise ValueError(f"Plan {plan_name} is not valid:\n  " + "\n  ".join(errors))
+
+    execution_plan = {
+        "plan_name": plan_name,
+        "compiled": datetime.now(timezone.utc).isoformat(),
+        "config": config,
+        "prompts": prompts,
+        "deps": deps,
+        "context": context,
+        "indices": list(range(run_range["start"]-1, min(run_range["end"], len(prompts)))),
+        "steps": steps
+    }
+    if output_folder is not None:
+        with open(os.path.join(output_folder, "execution-plan.json"), "w", encoding="utf-8") as f:
+            json.dump(execution_plan, f, indent=2, ensure_ascii=False)
+    return execution_plan
+
+def prepare_step(prompts, index, config, output_folder, context_names, echo=True):
+    """
+    Assembles the prompt and settings for one plan step
+    Args:
+        prompts (list): List of prompt dicts from the plan yaml
+        index (int): Index of the step
+        config (dict): Plan config
+        output_folder (str): Folder with the earlier responses
+        context_names (list): Names of the earlier steps whose responses are context, in plan order
+        echo (bool): Log the step's instructions and lit files
+    Returns:
+        dict: Step name, model settings, prompt (blocks and text), system prompt, ledger labels and input hash
+    """
+    prompt = prompts[index]
+
+    if echo:
+        logging.info("==== FEEDBACK ====")
+        logging.info(f"Processing prompt number {index+1}...")
+        logging.info(f"Instructions: {prompt['instructions']}")
+
+        if "lit_files" in prompt:
+            logging.info(f"Lit files: {prompt['lit_files']}")
+
+    # Previous responses context
+    prev_responses = [f"{output_folder}{fname}-response.md" for fname in context_names]
+
+    # Literature context
+    if "lit_files" in prompt:
+        lit_files = [f"./lit-context/{fname}" for fname in prompt["lit_files"]]
+    else:
+        lit_files = []
+
+    # LaTeX files
+    if "latex_files" in prompt:
+        latex_files = [f"./latex-input/{fname}" for fname in prompt["latex_files"]]
+    else:
+        latex_files = []
+
+    # Generate the full prompt
+    # earlier responses come first, each in its own block, so later prompts share them as a cached prefix
+    # cache breakpoints: after the last earlier response, and after all the context
+    context_files = prev_responses + lit_files + latex_files
+    prompt_blocks = assemble_prompt_blocks(
+        instructions=prompt["instructions"],
+        context_files=context_files,
+        cache_after=context_files[-1:] + prev_responses[-1:]
+    )
+
+    # by default, use system prompt
+    if prompt.get("use_system_prompt", config["use_system_prompt"]):
+        system_prompt = config["system_prompt"]
+    else:
+        system_prompt = ""
+
+    # Get max_tokens and thinking_budget from prompt or use defaults
+    step = {
+        "index": index,
+        "name": prompt["name"],
+        "model_name": prompt["model_name"],
+        "max_tokens": prompt.get("max_tokens", config["max_tokens"]),
+        "thinking_budget": prompt.get("thinking_budget", config["thinking_budget"]),
+        "temperature": config["temperature"],
+        "prompt_blocks": prompt_blocks,
+        "full_prompt": prompt_text(prompt_blocks),
+        "system_prompt": system_prompt,
+        "lit_files": lit_files,
+        # ledger labels: the run this step belongs to and when it started
+        "run": ledger_run_name(output_folder),
+        "prepared": datetime.now(timezone.utc).isoformat(),
+        # the response streams here, so an interrupted generation can be resumed
+        "partial_file": f"{output_folder}{prompt['name']}-response.partial",
+        # models to try, in order, if the step's model keeps failing, and the time each one gets
+        "fallback_models": prompt.get("fallback_models", config.get("fallback_models", [])),
+        "deadline_seconds": prompt.get("deadline_seconds", config.get("deadline_seconds"))
+    }
+
+    step["input_hash"] = step_input_hash(step["full_prompt"], system_prompt, {
+        "model_name": step["model_name"],
+        "max_tokens": step["max_tokens"],
+        "thinking_budget": step["thinking_budget"],
+        "temperature": step["temperature"],
+        "convert_all_latex": config["convert_all_latex"]
+    })
+
+    return step
+
+def save_step_prompt(step, output_folder):
+    """Saves the system prompt and full prompt of a step"""
+    with open(f"{output_folder}{step['name']}-system-prompt.xml", "w", encoding="utf-8") as f:
+        f.write(step["system_prompt"])
+    with open(f"{output_folder}{step['name']}-prompt.xml", "w", encoding="utf-8") as f:
+        f.write(step["full_prompt"])
+
+def query_model(step, model_name, echo=True, deadline=None):
+    """
+    Queries one model with the prompt of a step
+    Returns:
+        dict: Response, tokens and costs
+    """
+    if MODEL_CONFIG[model_name]["type"] == "anthropic":
+        return query_claude(
+            model_name=model_name,
+            full_prompt=step["prompt_blocks"],
+            system_prompt=step["system_prompt"],
+            max_tokens=step["max_tokens"],
+            temperature=step["temperature"],
+            thinking_budget=step["thinking_budget"],
+            echo=echo,
+            partial_file=step["partial_file"],
+            deadline=deadline
+        )
+    else:
+        return query_openai(
+            model_name=model_name,
+            full_prompt=step["full_prompt"],
+            system_prompt=step["system_prompt"],
+            max_tokens=step["max_tokens"],
+            deadline=deadline
+        )
+
+def query_step(step, echo=True):
+    """
+    Queries the model of a step. If it still fails after its retries (or misses the step's
+    deadline), the step's fallback models are tried in order.
+    Returns:
+        dict: Response, tokens and costs
+    """
+    logging.info("==== FEEDBACK ====")
+    logging.info(f"Querying {step['model_name']}")
+
+    models = [step["model_name"]] + step["fallback_models"]
+    with ledger_context(run=step["run"], prompt=step["name"], operation="Main"):
+        for i, model_name in enumerate(models):
+            deadline = time.time() + step["deadline_seconds"] if step["deadline_seconds"] else None
+            try:
+                return query_model(step, model_name, echo=echo, deadline=deadline)
+            except Exception as e:
+                if i == len(models) - 1:
+                    raise
+                logging.warning(f"{model_name} failed for {step['name']} ({e}), falling back to {models[i + 1]}")
+
+def finish_step(prompts, step, llmdat, config, output_folder):
+    """
+    Saves a step's response, converts it to LaTeX (if convert_all_latex), saves the costs
+    and records the step in the manifest
+    """
+    # save the response (replaced, not overwritten, since forked runs hard link the responses they share)
+    response_file = f"{output_folder}{step['name']}-response.md"
+    with open(f"{response_file}.tmp", "w", encoding="utf-8") as f:
+        f.write(llmdat["response"])
+    os.replace(f"{response_file}.tmp", response_file)
+
+    if config["convert_all_latex"]:
+        logging.info("==== FEEDBACK ====")
+        logging.info(f"Converting to LaTeX")
+
+        # Convert to LaTeX
+        latex_model = "haiku"
+        par_per_chunk = 5
+        if step["lit_files"] == []:
+            bibtex_input = None
+        else:
+            bibtex_input = "./lit-context/bibtex-all.bib"
+
+        latex_labels = {"run": step["run"], "prompt": step["name"], "operation": "LaTeX"}
+        with ledger_context(**latex_labels):
+            llmdat_texinput = response_to_texinput(
+                response_raw=llmdat["response"],
+                par_per_chunk=par_per_chunk,
+                model_name=latex_model,
+                bibtex_raw=bibtex_input
+            )
+
+        # Save texinput
+        texinput_file = f"{output_folder}{step['name']}-texinput.tex"
+        with open(texinput_file, 'w', encoding='utf-8') as file:
+            file.write(llmdat_texinput["response"])
+        logging.info(f"LaTeX input saved to {texinput_file}")
+
+        # Convert to PDF    
+        compile_result = texinput_to_pdf(llmdat_texinput["response"], f"{step['name']}-latex", output_folder)
+
+        # if the conversion fails, use sonnet to convert to latex
+        if compile_result["returncode"] != 0:
+            logging.warning("LaTeX conversion failed, using sonnet to convert to latex")
+            with ledger_context(**latex_labels):
+                llmdat_texinput = response_to_texinput(
+                    response_raw=llmdat["response"],
+                    par_per_chunk=par_per_chunk,
+                    model_name="sonnet"
+                )
+            texinput_to_pdf(llmdat_texinput["response"], f"{step['name']}-latex", output_folder)    
+
+    else:
+        logging.info("==== FEEDBACK ====")
+        logging.info(f"Skipping LaTeX conversion")
+
+    # write the step's cost table from the ledger
+    save_costs(step, output_folder)
+
+    # record the finished step so reruns can skip it, and where its costs are in the ledger
+    update_manifest(output_folder, step["name"], step["input_hash"], {
+        "run": step["run"],
+        "started": step["prepared"],
+        "ended": datetime.now(timezone.utc).isoformat()
+    })
+
+def full_paper_input_hash(last_prompt_name, output_folder):
+    """
+    Hashes everything the full paper pdf is built from: the full paper response, the LaTeX
+    inputs (including the appendices), econstyle.sty and the bib file
+    Returns:
+        str: sha256 hex digest
+    """
+    input_files = [f"{output_folder}{last_prompt_name}-response.md"]
+    input_files += sorted(glob.glob("latex-input/*.tex")) + ["latex-input/econstyle.sty", "lit-context/bibtex-all.bib"]
+
+    input_hash = hashlib.sha256()
+    for file in input_files:
+        # hash by file name, so the same run folder matches however its path is written
+        input_hash.update(os.path.basename(file).encode("utf-8"))
+        input_hash.update((_file_hash(file) or "missing").encode("utf-8"))
+    return input_hash.hexdigest()
+
+def stage_full_paper(last_prompt_name, output_folder):
+    """
+    Copies the LaTeX inputs to the output folder and extracts the LaTeX document from the full
+    paper response into {last_prompt_name}-cleaned.tex
+    Returns:
+        bool: False if the response has no \\documentclass ... \\end{document}
+    """
+    # copy latex-inputs to output folder
+    # Copy all .tex files from latex-input to output folder
+    logging.info("Copying .tex files from latex-input to output folder...")
+    for tex_file in glob.glob("latex-input/*.tex"):
+        shutil.copy(tex_file, output_folder)
+    shutil.copy("lit-context/bibtex-all.bib", output_folder)
+
+    # econstyle.sty points to the bib file with a relative path, which breaks when the
+    # output folder is nested (e.g. manyout*-detail/run01/), so point it to the copied bib
+    with open("latex-input/econstyle.sty", "r", encoding="utf-8") as f:
+        econstyle_content = f.read()
+    econstyle_content = econstyle_content.replace("../lit-context/", "./")
+    with open(f"{output_folder}econstyle.sty", "w", encoding="utf-8") as f:
+        f.write(econstyle_content)
+
+    # read in the full paper md response
+    with open(f"{output_folder}{last_prompt_name}-response.md", "r", encoding="utf-8") as f:
+        full_paper_md = f.read()
+
+    # remove everything between \documentclass and \end{document}
+    i_start = full_paper_md.find("\\documentclass")
+    i_end = full_paper_md.find("\\end{document}")
+    if i_start == -1 or i_end == -1:
+        return False
+    full_paper_md = full_paper_md[i_start:i_end + len("\\end{document}")]
+
+    # update "../latex-input/" to "./"
+    full_paper_md = full_paper_md.replace("../latex-input/", "./")
+
+    # save the full paper md
+    with open(f"{output_folder}{last_prompt_name}-cleaned.tex", "w", encoding="utf-8") as f:
+        f.write(full_paper_md)
+    return True
+
+def compile_full_paper(plan_name, last_prompt_name, output_folder):
+    """
+    Generates the appendices, copies the LaTeX inputs to the output folder, extracts the
+    LaTeX document from the full paper response and compiles it
+    Returns:
+        The tex_to_pdf result
+    """
+    logging.info("==== FEEDBACK ====")
+    logging.info(f"Compiling full paper LaTeX")
+
+    # Generate appendix first
+    logging.info("Generating appendix with README...")
+    create_readme_appendix()
+
+    logging.info("Generating appendix with prompt listing...")
+    create_appendix(plan_name + ".yaml")
+
+    input_hash = full_paper_input_hash(last_prompt_name, output_folder)
+    if not stage_full_paper(last_prompt_name, output_folder):
+        logging.warning(f"No LaTeX document found in {output_folder}{last_prompt_name}-response.md")
+        return {"returncode": 1, "passes": [], "errors": ["no LaTeX document in the response"], "seconds": 0.0}
+
+    # compile the full paper, and record the build so update-many-appendices.py can skip it
+    compile_result = tex_to_pdf(f"{last_prompt_name}-cleaned", output_folder)
+    if compile_result["returncode"] == 0:
+        update_manifest(output_folder, "full-paper-pdf", input_hash)
+    return compile_result
+
+def refresh_full_paper(run_folder, last_prompt_name, dest_pdf, force=False):
+    """
+    Rebuilds the full paper pdf in a run folder and copies it to dest_pdf, unless the inputs
+    hash the same as at the last successful build. Run from the repo root, the appendices must
+    already be up to date.
+    Args:
+        run_folder (str): Run folder, ending with a slash
+        last_prompt_name (str): Name of the full paper prompt
+        dest_pdf (str): Where to copy the pdf
+        force (bool): Rebuild even if the inputs are unchanged
+    Returns:
+        dict: run_folder, status ("built", "skipped", or "failed"), seconds, errors, passes
+    """
+    time_start = time.time()
+    result = {"run_folder": run_folder, "status": "failed", "seconds": 0.0, "errors": [], "passes": []}
+    source_pdf = f"{run_folder}{last_prompt_name}-cleaned.pdf"
+
+    if not os.path.exists(f"{run_folder}{last_prompt_name}-response.md"):
+        result["errors"].append(f"{last_prompt_name}-response.md not found")
+        return result
+
+    input_hash = full_paper_input_hash(last_prompt_name, run_folder)
+    entry = load_manifest(run_folder).get("full-paper-pdf")
+    if not force and entry is not None and entry["input_hash"] == input_hash and os.path.exists(source_pdf):
+        result["status"] = "skipped"
+    elif not stage_full_paper(last_prompt_name, run_folder):
+        result["errors"].append("no LaTeX document in the response")
+    else:
+        compile_result = tex_to_pdf(f"{last_prompt_name}-cleaned", run_folder)
+        result["passes"] = compile_result["passes"]
+        result["errors"] = compile_result["errors"]
+        if compile_result["returncode"] == 0 and os.path.exists(source_pdf):
+            update_manifest(run_folder, "full-paper-pdf", input_hash)
+            result["status"] = "built"
+        elif compile_result["returncode"] == 0:
+            result["errors"].append(f"{source_pdf} not found")
+
+    if result["status"] != "failed":
+        shutil.copy2(source_pdf, dest_pdf)
+    result["seconds"] = time.time() - time_start
+    return result
+
+def write_text_atomic(path, text):
+    """
+    Writes text to path through a temp file and os.replace, so parallel runs that read the
+    file (e.g. an appendix used as prompt context) never see it half written. Skips the write
+    if the file already has this text.
+    """
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            if f.read() == text:
+                return
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(temp_path, path)
 
 def create_appendix(plan_file, output_file="latex-input/appendix-promptlisting.tex"):
     """
@@ -528,8 +2903,7 @@ def create_appendix(plan_file, output_file="latex-input/appendix-promptlisting.t
         appendix.append(format_prompt_for_latex(prompt))
         
     # Write to file
-    with open(output_file, "w", encoding="utf-8") as f:
-        f.write('\n'.join(appendix))
+    write_text_atomic(output_file, '\n'.join(appendix))
 
 def format_prompt_for_latex(prompt):
     """Format a single prompt for LaTeX output."""
@@ -605,8 +2979,7 @@ def create_readme_appendix(output_file="latex-input/appendix-readme.tex"):
     appendix.append("\\vspace{-3ex}")
     
     # Write to file
-    with open(output_file, "w", encoding="utf-8") as f:
-        f.write('\n'.join(appendix))
+    write_text_atomic(output_file, '\n'.join(appendix))
 
 # is jupyter notebook?
 def is_jupyter():